@@ -1,17 +1,75 @@
-from fastapi import FastAPI, Request
-from fastapi.responses import RedirectResponse
-from fastapi.middleware.cors import CORSMiddleware
-from starlette.middleware.sessions import SessionMiddleware
-from .schemas import model
-from .schemas.database import engine
-from .router.user import user
-from .router.play import play
 from dotenv import load_dotenv
-import os
 
+# Read before any module below takes its settings from the environment
 load_dotenv()
 
-app = FastAPI()
+from fastapi import FastAPI, Request, Header, HTTPException  # noqa: E402
+from fastapi.responses import RedirectResponse  # noqa: E402
+from fastapi.middleware.cors import CORSMiddleware  # noqa: E402
+from starlette.middleware.sessions import SessionMiddleware  # noqa: E402
+from sqlalchemy import select  # noqa: E402
+from .schemas import spotify, metrics, trigram, listens, rollups, outbox, jobs, migrations  # noqa: E402
+from .schemas.database import session, close_engines  # noqa: E402
+from .schemas.broker import discussions  # noqa: E402
+from .router.user import user  # noqa: E402
+from .router.play import play  # noqa: E402
+from contextlib import asynccontextmanager  # noqa: E402
+import asyncio  # noqa: E402
+import logging  # noqa: E402
+import time  # noqa: E402
+import os  # noqa: E402
+
+# How long startup may wait on the warm-up before serving; whatever is left carries on in the background
+WARMUP_BUDGET = float(os.getenv('STARTUP_WARMUP_BUDGET', 2))
+startup = {'warmup_done': False, 'warmup_seconds': None}
+metrics.register('startup', lambda: startup)
+
+
+async def warm_up():
+    start = time.perf_counter()
+    try:
+        async with session() as db:
+            # Opens the first pooled connection; the in-process search index is built from the same session
+            await db.execute(select(1))
+            if trigram.use_index():
+                await trigram.load_playlists(db)
+        startup['warmup_done'] = True
+    except Exception:
+        logging.exception("Startup warm-up failed")
+    startup['warmup_seconds'] = round(time.perf_counter() - start, 3)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    async with session() as db:
+        await migrations.check(db)
+    warmup = asyncio.create_task(warm_up())
+    tasks = [warmup, asyncio.create_task(listens.flush_loop()), asyncio.create_task(rollups.rollup_loop()),
+             asyncio.create_task(outbox.outbox_loop()), asyncio.create_task(jobs.job_loop())]
+    if trigram.use_index():
+        tasks.append(asyncio.create_task(trigram.refresh_loop()))
+    if WARMUP_BUDGET > 0:
+        await asyncio.wait({warmup}, timeout=WARMUP_BUDGET)
+        if not warmup.done():
+            logging.warning(f"Warm-up still running after {WARMUP_BUDGET}s, serving requests meanwhile")
+
+    yield
+
+    for task in tasks:
+        task.cancel()
+    # Let cancelled loops unwind first; an interrupted listen flush puts its batch back for drain() below
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # Running jobs go back to the queue and resume on the next start
+    await jobs.close()
+    # Write out whatever listens are still buffered
+    await listens.drain()
+    await discussions.close()
+    await spotify.close_client()
+    await outbox.close_client()
+    await close_engines()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -27,6 +85,23 @@ app.include_router(user, prefix="/user", tags=["User"])
 app.include_router(play, prefix="/play", tags=["Play"])
 
 
+@app.middleware("http")
+async def count_upstream_calls(request: Request, call_next):
+    calls = metrics.begin_request()
+    response = await call_next(request)
+    route = request.scope.get('route')
+    metrics.end_request(route.path if route else 'unmatched', calls)
+    return response
+
+
+@app.get("/metrics", include_in_schema=False)
+def read_metrics(x_metrics_token: str | None = Header(None)):
+    expected = os.getenv("METRICS_TOKEN")
+    if expected and x_metrics_token != expected:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return metrics.snapshot()
+
+
 @app.get("/dashboard")
 def read_root(request: Request):
     token = request.session.get("access_token")
@@ -36,9 +111,6 @@ def read_root(request: Request):
     return {"message": "Welcome to the dashboard"}
 
 
-model.data.metadata.create_all(bind=engine)
-
-
 @app.get("/")
 def home():
     return {"message": "Welcome to the Spotify API"}
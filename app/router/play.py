@@ -1,43 +1,64 @@
-from fastapi import APIRouter, Cookie, HTTPException, Request
+from fastapi import APIRouter, Cookie, HTTPException, Request, Query, WebSocket
 from fastapi.responses import RedirectResponse
 from starlette import status
-from sqlalchemy import desc, asc
+from sqlalchemy import desc, asc, select, insert, update, delete, func, or_, and_, tuple_
 from .user import refresh_access_token
-from ..schemas.config import db_dependency, user_dependency, check_expired_token
+from ..schemas.database import insert_or_ignore, session
+from ..schemas.config import db_dependency, user_dependency, check_expired_token, get_spotify_id, invalidate_user, \
+    get_user
+from ..schemas import spotify, tracks, listens, counters, rollups, jobs
+from ..schemas.pagination import encode_cursor, decode_cursor
+from ..schemas.trigram import playlist_index, use_index, SIMILARITY_THRESHOLD
+from ..schemas.cache import CoalescingCache
+from ..schemas.broker import discussions
+from collections import defaultdict
+from typing import Literal
 from ..schemas.model import *
 from ..schemas.user_schemas import *
-import requests
 import logging
+import asyncio
 import json
+import os
 
 play = APIRouter()
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+search_cache = CoalescingCache('search_cache',
+                               maxsize=int(os.getenv('SEARCH_CACHE_SIZE', 2048)),
+                               ttl=int(os.getenv('SEARCH_CACHE_TTL', 600)))
+
+DISCUSSION_PAGE_SIZE = int(os.getenv('DISCUSSION_PAGE_SIZE', 50))
+
 
 @play.get('/search')
 async def search_tracks_spotify(name: str,
                                 request: Request,
                                 user: user_dependency,
+                                db: db_dependency,
                                 token: str | None = Cookie(None, alias="access_token")):
     if not token or not user:
         return RedirectResponse(url='/user/login')
-    if check_expired_token(token):
+    if await check_expired_token(token):
         return await refresh_access_token(request, val=None, url=f'/play/search?name={name}')
 
-    search_response = requests.get(
-        'https://api.spotify.com/v1/search',
-        headers={'Authorization': f'Bearer {token}'},
-        params={
-            'q': name,
-            'type': 'track',
-            'limit': 15
-        }
-    )
-    if search_response.status_code == 200:
-        search_data = search_response.json()
+    query = ' '.join(name.casefold().split())
+
+    async def fetch_tracks():
+        search_response = await spotify.api(
+            'GET', '/search', token,
+            params={
+                'q': query,
+                'type': 'track',
+                'limit': 15
+            }
+        )
+        if search_response.status_code != 200:
+            raise HTTPException(status_code=search_response.status_code, detail=search_response.json())
 
-        tracks = [
+        search_data = search_response.json()
+        tracks.remember(search_data['tracks']['items'])
+        return [
             {
                 'track_id': item['id'],
                 'name': item['name'],
@@ -46,10 +67,60 @@ async def search_tracks_spotify(name: str,
             }
             for item in search_data['tracks']['items']
         ]
-        return {'tracks': tracks}
 
-    else:
-        raise HTTPException(status_code=search_response.status_code, detail=search_response.json())
+    found = await search_cache.get(query, fetch_tracks)
+    await tracks.save_pending(db)
+    return {'tracks': found}
+
+
+async def collaborators(db, playlist_ids) -> dict[str, list[str]]:
+    names = defaultdict(list)
+    if not playlist_ids:
+        return names
+    rows = await db.execute(
+        select(playlist_users.c.playlist_id, UserModel.username).
+        join(UserModel, UserModel.id == playlist_users.c.user_id).
+        where(playlist_users.c.playlist_id.in_(playlist_ids))
+    )
+    for playlist_id, username in rows:
+        names[playlist_id].append(username)
+    return names
+
+
+async def search_playlists_sql(db, name: str, limit: int, last: list | None):
+    # ix_playlist_name_trgm serves ilike and the % operator, not similarity() compared to a constant.
+    # % matches at pg_trgm.similarity_threshold, set for this transaction only
+    await db.execute(select(func.set_config('pg_trgm.similarity_threshold', str(SIMILARITY_THRESHOLD), True)))
+    similarity = func.similarity(Playlist.name, name)
+    query = select(Playlist, similarity).where(
+        (Playlist.name.ilike(f"%{name}%")) |
+        (Playlist.name.op('%')(name))
+    )
+    if last:
+        last_score, last_id = last
+        query = query.where(or_(similarity < last_score, and_(similarity == last_score, Playlist.id > last_id)))
+
+    return (await db.execute(query.order_by(desc(similarity), Playlist.id).limit(limit + 1))).all()
+
+
+async def search_playlists_index(db, name: str, limit: int, last: list | None):
+    matches = playlist_index.search(name)
+    if last:
+        last_score, last_id = last
+        matches = [(score, playlist_id) for score, playlist_id in matches
+                   if score < last_score or (score == last_score and playlist_id > last_id)]
+
+    # The index can still hold playlists deleted by another worker until its next refresh. Those are
+    # dropped before slicing, reading further candidates until the page (plus one for the cursor) is full
+    rows = []
+    start = 0
+    while len(rows) <= limit and start < len(matches):
+        batch = matches[start:start + limit + 1 - len(rows)]
+        start += len(batch)
+        found = {item.id: item for item in await db.scalars(
+            select(Playlist).where(Playlist.id.in_([playlist_id for _, playlist_id in batch])))}
+        rows += [(found[playlist_id], score) for score, playlist_id in batch if playlist_id in found]
+    return rows
 
 
 @play.get('/playlists/search', response_model=PlaylistResponse)
@@ -57,27 +128,26 @@ async def find_playlists(name: str,
                          user: user_dependency,
                          db: db_dependency,
                          request: Request,
+                         limit: int = Query(20, ge=1, le=100),
+                         cursor: str | None = None,
                          token: str | None = Cookie(None, alias="access_token")):
     if not user or not token:
         return RedirectResponse(url='/user/login')
-    if check_expired_token(token):
-        return await refresh_access_token(request, val=None, url=f'/play/playlists/search?name={name}')
+    if await check_expired_token(token):
+        return await refresh_access_token(request, val=None, url=f'/play/playlists/search?{request.url.query}')
 
-    playlist_search = db.query(Playlist).filter(
-        (Playlist.name.ilike(f"%{name}%")) |
-        (func.similarity(Playlist.name, name) > 0.2)
-    ).order_by(
-        desc(func.similarity(Playlist.name, name))
-    ).all()
+    search = search_playlists_index if use_index() else search_playlists_sql
+    rows = await search(db, name, limit, decode_cursor(cursor, 2) if cursor else None)
+    next_cursor = encode_cursor(rows[limit - 1][1], rows[limit - 1][0].id) if len(rows) > limit else None
+    playlist_search = [item for item, _ in rows[:limit]]
+    collab = await collaborators(db, [item.id for item in playlist_search])
 
     playlist = []
 
     for item in playlist_search:
-        collab = [user.username for user in item.users]
-
         playlist_data = PlaylistReturn(
             name=item.name,
-            username=collab,
+            username=collab[item.id],
             genre=item.genre,
             likes=item.likes,
             plays=item.plays,
@@ -91,7 +161,7 @@ async def find_playlists(name: str,
     if not playlist_search:
         return {'message': 'No playlist with that keyword, maybe you can create one'}
 
-    return {'playlists': playlist}
+    return {'playlists': playlist, 'next_cursor': next_cursor}
 
 
 @play.get('/search/playlist')
@@ -100,22 +170,60 @@ async def get_playlist_id(payload: AlterPlaylist,
                           db: db_dependency):
     if not user:
         return RedirectResponse(url='/user/login')
-    playlist = db.query(Playlist).filter(Playlist.id == payload.id).first()
+    playlist = await db.get(Playlist, payload.id)
     if not playlist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Playlist not found')
     return playlist
 
 
+async def new_playlist(db, user, token: str, payload: PlaylistCreate | PlaylistPrivateCreate,
+                       progress: dict | None = None, report=None) -> dict:
+    playlist_id = (progress or {}).get('playlist_id')
+    if playlist_id is None:
+        user_id = await get_spotify_id(user, db, token)
+        playlist = await spotify.api(
+            'POST', f'/users/{user_id}/playlists', token,
+            json=payload.model_dump()
+        )
+        if playlist.status_code != 201:
+            raise HTTPException(status_code=playlist.status_code, detail=f'Failed to create playlist: {playlist.json()}')
+        playlist_id = playlist.json().get('id')
+        if report:
+            # A resumed job must not create a second playlist on spotify
+            await report(playlist_id=playlist_id)
+
+    if not await db.get(Playlist, playlist_id):
+        new = Playlist(
+            id=playlist_id,
+            name=payload.name,
+            user_id=user.id,
+        )
+
+        db.add(new)
+        await db.flush()
+        await db.execute(insert(playlist_users).values(playlist_id=new.id, user_id=user.id))
+        await counters.apply(db, (UserModel.created_playlist, user.id, 1))
+        await db.commit()
+        invalidate_user(user.id)
+        playlist_index.add(playlist_id, payload.name)
+
+        visibility = 'private' if isinstance(payload, PlaylistPrivateCreate) else 'public'
+        logging.info(f"User with id: {user.id} has created a {visibility} playlist with id: {playlist_id}")
+
+    return {'message': 'Playlist created successfully', 'playlist_id': playlist_id}
+
+
 @play.post('/create')
 async def create_playlist(user: user_dependency,
                           db: db_dependency,
                           request: Request,
                           token: str | None = Cookie(None, alias="access_token"),
-                          payload: PlaylistCreate | None = None
+                          payload: PlaylistCreate | None = None,
+                          mode: Literal['sync', 'async'] = 'sync'
                           ):
     if not user or not token:
         return RedirectResponse(url='/user/login')
-    if check_expired_token(token):
+    if await check_expired_token(token):
         val = json.dumps(payload.dict())
         return await refresh_access_token(request, val=val, url='/play/create')
 
@@ -123,53 +231,9 @@ async def create_playlist(user: user_dependency,
         payload_j = request.cookies.get('payload')
         payload = PlaylistCreate(**(json.loads(payload_j)))
 
-    user_info = requests.get(
-        'https://api.spotify.com/v1/me',
-        headers={
-            'Authorization': f'Bearer {token}'
-        }
-    )
-    if user_info.status_code == 200:
-        user_data = user_info.json()
-        user_id = user_data.get('id')
-    else:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Failed to verify access token')
-
-    if not user_id:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='User Id not found')
-
-    playlist = requests.post(
-        f'https://api.spotify.com/v1/users/{user_id}/playlists',
-        headers={
-            'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'},
-        json=payload.model_dump()
-    )
-
-    if playlist.status_code == 201:
-        playlist_data = playlist.json()
-        playlist_id = playlist_data.get('id')
-        new = Playlist(
-            id=playlist_id,
-            name=payload.name,
-            user_id=user.id,
-        )
-
-        new.users.append(user)
-
-        add_user = db.query(UserModel).filter(UserModel.id == user.id).first()
-        if not add_user:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Unauthorized user')
-        add_user.created_playlist += 1
-
-        db.add(new)
-        db.commit()
-
-        logging.info(f"User with id: {user.id} has created a public playlist with id: {playlist_id}")
-
-        return {'message': 'Playlist created successfully'}
-
-    else:
-        raise HTTPException(status_code=playlist.status_code, detail=f'Failed to create playlist: {playlist.json()}')
+    if mode == 'async':
+        return jobs.accepted(await jobs.submit(db, user.id, 'create', token, payload))
+    return await new_playlist(db, user, token, payload)
 
 
 @play.post('/create/private')
@@ -178,11 +242,12 @@ async def create_playlist_private(
         db: db_dependency,
         request: Request,
         token: str | None = Cookie(None, alias="access_token"),
-        payload: PlaylistPrivateCreate | None = None
+        payload: PlaylistPrivateCreate | None = None,
+        mode: Literal['sync', 'async'] = 'sync'
 ):
     if not token or not user:
         return RedirectResponse(url='user/login')
-    if check_expired_token(token):
+    if await check_expired_token(token):
         val = json.dumps(payload.dict())
         return await refresh_access_token(request, val=val, url='/play/create/private')
 
@@ -190,54 +255,9 @@ async def create_playlist_private(
         payload_j = request.cookies.get('payload')
         payload = PlaylistPrivateCreate(**(json.loads(payload_j)))
 
-    user_info = requests.get(
-        'https://api.spotify.com/v1/me',
-        headers={
-            'Authorization': f'Bearer {token}'
-        }
-    )
-
-    if user_info.status_code == 200:
-        user_data = user_info.json()
-        user_id = user_data.get('id')
-    else:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Failed to verify access token')
-
-    if not user_id:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='User Id not found')
-
-    playlist = requests.post(
-        f'https://api.spotify.com/v1/users/{user_id}/playlists',
-        headers={
-            'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'},
-        json=payload.model_dump()
-    )
-
-    if playlist.status_code == 201:
-        playlist_data = playlist.json()
-        playlist_id = playlist_data.get('id')
-        new = Playlist(
-            id=playlist_id,
-            name=payload.name,
-            user_id=user.id,
-        )
-
-        add_user = db.query(UserModel).filter(UserModel.id == user.id).first()
-        if not add_user:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Unauthorized user')
-        add_user.created_playlist += 1
-
-        new.users.append(user)
-
-        db.add(new)
-        db.commit()
-
-        logging.info(f"User with id: {user.id} has created a private playlist with id: {playlist_id}")
-
-        return {'message': 'Playlist created successfully'}
-
-    else:
-        raise HTTPException(status_code=playlist.status_code, detail=f'Failed to create playlist {playlist.json()}')
+    if mode == 'async':
+        return jobs.accepted(await jobs.submit(db, user.id, 'create_private', token, payload))
+    return await new_playlist(db, user, token, payload)
 
 
 @play.put('/make_public')
@@ -248,7 +268,7 @@ async def private_to_public(user: user_dependency,
                             payload: AlterPlaylist | None = None):
     if not user or not token:
         return RedirectResponse(url='user/login')
-    if check_expired_token(token):
+    if await check_expired_token(token):
         val = json.dumps(payload.dict())
         return await refresh_access_token(request, val=val, url='/play/make_public')
 
@@ -256,26 +276,13 @@ async def private_to_public(user: user_dependency,
         payload_j = request.cookies.get('payload')
         payload = AlterPlaylist(**(json.loads(payload_j)))
 
-    user_info = requests.get(
-        'https://api.spotify.com/v1/me',
-        headers={
-            'Authorization': f'Bearer {token}'
-        }
-    )
-
-    if user_info.status_code != 200:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Failed to verify access token')
-
-    playlist = db.query(Playlist).filter(Playlist.id == payload.id).first()
+    playlist = await db.get(Playlist, payload.id)
     if not playlist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Playlist not found')
 
     playlist_id = playlist.id
-    playlist_update = requests.put(
-        f'https://api.spotify.com/v1/playlists/{playlist_id}/',
-        headers={
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json'},
+    playlist_update = await spotify.api(
+        'PUT', f'/playlists/{playlist_id}', token,
         json={'collaborative': True,
               'public': False}
     )
@@ -294,7 +301,7 @@ async def public_to_private(user: user_dependency,
                             payload: AlterPlaylist | None = None):
     if not user or not token:
         return RedirectResponse(url='/user/login')
-    if check_expired_token(token):
+    if await check_expired_token(token):
         val = json.dumps(payload.dict())
         return await refresh_access_token(request, val=val, url='/play/make_private')
 
@@ -302,24 +309,13 @@ async def public_to_private(user: user_dependency,
         payload_j = request.cookies.get('payload')
         payload = AlterPlaylist(**(json.loads(payload_j)))
 
-    user_info = requests.get(
-        'https://api.spotify.com/v1/me',
-        headers={'Authorization': f'Bearer {token}'}
-    )
-
-    if user_info.status_code != 200:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Failed to verify access token')
-
-    playlist = db.query(Playlist).filter(Playlist.id == payload.id).first()
+    playlist = await db.get(Playlist, payload.id)
     if not playlist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Playlist not found')
     playlist_id = playlist.id
 
-    playlist_update = requests.put(
-        f'https://api.spotify.com/v1/playlists/{playlist_id}/',
-        headers={'Authorization': f'Bearer {token}',
-                 'Content-Type': 'application/json'
-                 },
+    playlist_update = await spotify.api(
+        'PUT', f'/playlists/{playlist_id}', token,
         json={'collaborative': False,
               'public': False}
     )
@@ -330,15 +326,75 @@ async def public_to_private(user: user_dependency,
     return {'message': 'Playlist can now be edited by you only'}
 
 
+async def record_contribution(db, playlist_id: str, user_id: int, delta_ms: int):
+    await db.execute(tracks.adjust_time(playlist_id, delta_ms))
+    exist = await db.scalar(select(playlist_users.c.user_id).where(playlist_users.c.playlist_id == playlist_id).
+                            where(playlist_users.c.user_id == user_id))
+    if not exist:
+        await db.execute(insert(playlist_users).values(playlist_id=playlist_id, user_id=user_id))
+    await db.commit()
+
+
+def chunk_progress(result: dict, track_ids: list[str], skipped: int) -> dict:
+    return {
+        'sent': len(result['done']),
+        'total': len(track_ids),
+        'skipped': skipped,
+        'chunks': -(-len(result['done']) // spotify.CHUNK_SIZE),
+        'snapshot_id': result['snapshot_id'],
+    }
+
+
+async def add_tracks(db, user, token: str, payload: AddTrack, progress: dict | None = None, report=None) -> dict:
+    playlist = await db.get(Playlist, payload.id)
+    if not playlist:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Playlist not found')
+    collab = await spotify.api('GET', f'/playlists/{playlist.id}', token)
+    if collab.status_code != 200:
+        raise HTTPException(status_code=collab.status_code, detail=collab.json())
+    tracks.remember(item.get('track') for item in collab.json()['tracks']['items'])
+
+    if not collab.json().get('collaborative'):
+        if playlist.user_id != user.id:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='You can not contribute to this playlist')
+
+    track_ids, skipped = tracks.clean_ids(payload.track_id)
+    if len(track_ids) == 0:
+        return {"message": "No track was specified!"}
+    known = await tracks.resolve_durations(track_ids, token, db)
+
+    # Tracks an earlier run of the same job already pushed; sending them again would duplicate them
+    sent = (progress or {}).get('sent', 0)
+
+    async def on_progress(count):
+        await report(sent=sent + count, total=len(track_ids))
+
+    result = await spotify.add_playlist_tracks(playlist.id, track_ids[sent:], token, on_progress if report else None)
+    result['done'] = track_ids[:sent] + result['done']
+    # Keep the chunks that went through even if a later one failed
+    if result['done']:
+        await record_contribution(db, playlist.id, user.id, sum(known.get(track, 0) for track in result['done']))
+    progress = chunk_progress(result, track_ids, skipped)
+
+    if result['error'] is not None:
+        raise HTTPException(status_code=result['error'].status_code,
+                            detail={'error': result['error'].json(), **progress})
+
+    logging.info(f"The playlist: {playlist.id} has been altered by user: {user.id}")
+
+    return {'message': 'Track added to playlist successfully', **progress}
+
+
 @play.put('/alter')
 async def alter_playlist(user: user_dependency,
                          db: db_dependency,
                          request: Request,
                          token: str | None = Cookie(None, alias="access_token"),
-                         payload: AddTrack | None = None):
+                         payload: AddTrack | None = None,
+                         mode: Literal['sync', 'async'] = 'sync'):
     if not user or not token:
         return RedirectResponse(url='/user/login')
-    if check_expired_token(token):
+    if await check_expired_token(token):
         val = json.dumps(payload.dict())
         return await refresh_access_token(request, val=val, url='/play/alter')
 
@@ -346,63 +402,53 @@ async def alter_playlist(user: user_dependency,
         payload_j = request.cookies.get('payload')
         payload = AddTrack(**(json.loads(payload_j)))
 
-    user_info = requests.get(
-        'https://api.spotify.com/v1/me',
-        headers={'Authorization': f'Bearer {token}'}
-    )
+    if mode == 'async':
+        return jobs.accepted(await jobs.submit(db, user.id, 'alter', token, payload))
+    return await add_tracks(db, user, token, payload)
 
-    if user_info.status_code != 200:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Failed to verify access token')
 
-    playlist = db.query(Playlist).filter(Playlist.id == payload.id).first()
-    collab = requests.get(
-        f'https://api.spotify.com/v1/playlists/{playlist.id}',
-        headers={'Authorization': f'Bearer {token}'}
-    )
-    if collab.status_code != 200:
-        raise HTTPException(status_code=collab.status_code, detail=collab.json())
+async def drop_tracks(db, user, token: str, payload: AddTrack, progress: dict | None = None, report=None) -> dict:
+    playlist = await db.get(Playlist, payload.id)
+    if not playlist:
+        return {'message': 'Playlist not found!'}
+
+    track_ids, skipped = tracks.clean_ids(payload.track_id)
+    if not track_ids:
+        return {'message': 'No valid track found'}
 
+    collab = await spotify.api('GET', f'/playlists/{payload.id}', token)
+    if collab.status_code == 200:
+        tracks.remember(item.get('track') for item in collab.json()['tracks']['items'])
     if not collab.json().get('collaborative'):
         if playlist.user_id != user.id:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='You can not contribute to this playlist')
-
-    track_id = [f'spotify:track:{track}' for track in payload.track_id if len(track) == 22]
-    if len(track_id) == 0:
-        return {"message": "No track was specified!"}
-
-    add_track = requests.post(
-        f'https://api.spotify.com/v1/playlists/{playlist.id}/tracks',
-        headers={'Authorization': f'Bearer {token}',
-                 'Content-Type': 'application/json'
-                 },
-        json={'uris': track_id}
-    )
-
-    if add_track.status_code == 201:
-        time = requests.get(
-            f'https://api.spotify.com/v1/playlists/{playlist.id}',
-            headers={'Authorization': f'Bearer {token}'}
-        )
-
-        if time.status_code != 200:
-            raise HTTPException(status_code=time.status_code, detail=time.json())
-
-        time_sum = sum(item['track']['duration_ms'] for item in time.json()['tracks']['items'])
-        time_sum = time_sum // 1000
+            return {'message': 'This playlist is private'}
+    # Spotify answers 200 for ids that aren't in the playlist and drops every copy of those that are,
+    # so the time goes down by each copy actually there
+    removing = set(track_ids)
+    copies = defaultdict(int)
+    durations = {}
+    for track in await tracks.playlist_items(playlist.id, token):
+        if track.get('id') in removing:
+            copies[track['id']] += 1
+            durations[track['id']] = track.get('duration_ms') or 0
+
+    # Removing a track twice is harmless, so a resumed job simply runs every chunk again
+    async def on_progress(count):
+        await report(removed=count, total=len(track_ids))
+
+    result = await spotify.remove_playlist_tracks(playlist.id, track_ids, token, on_progress if report else None)
+    if result['done']:
+        await record_contribution(db, playlist.id, user.id,
+                                  -sum(durations.get(track, 0) * copies[track] for track in result['done']))
+    progress = chunk_progress(result, track_ids, skipped)
+
+    if result['error'] is not None:
+        raise HTTPException(status_code=result['error'].status_code,
+                            detail={'error': result['error'].json(), **progress})
 
-        playlist.time = time_sum
-        exist = (db.query(playlist_users).filter(playlist_users.c.playlist_id == playlist.id).
-                 filter(playlist_users.c.user_id == user.id).first())
-        if not exist:
-            playlist.users.append(user)
-        db.add(playlist)
-        db.commit()
+    logging.info(f"The playlist: {playlist.id} has been altered by user: {user.id}")
 
-        logging.info(f"The playlist: {playlist.id} has been altered by user: {user.id}")
-
-        return {'message': 'Track added to playlist successfully'}
-    else:
-        raise HTTPException(status_code=add_track.status_code, detail=add_track.json())
+    return {'message': 'Tracks removed from the playlist successfully', **progress}
 
 
 @play.put('/alter/d')
@@ -410,10 +456,11 @@ async def remove_tracks(user: user_dependency,
                         db: db_dependency,
                         request: Request,
                         token: str | None = Cookie(None, alias="access_token"),
-                        payload: AddTrack | None = None):
+                        payload: AddTrack | None = None,
+                        mode: Literal['sync', 'async'] = 'sync'):
     if not user or not token:
         return RedirectResponse(url='user/login')
-    if check_expired_token(token):
+    if await check_expired_token(token):
         val = json.dumps(payload.dict())
         return await refresh_access_token(request, val=val, url='/play/alter/d')
 
@@ -421,63 +468,62 @@ async def remove_tracks(user: user_dependency,
         payload_j = request.cookies.get('payload')
         payload = AddTrack(**(json.loads(payload_j)))
 
-    user_info = requests.get(
-        'https://api.spotify.com/v1/me',
-        headers={'Authorization': f'Bearer {token}'}
-    )
-    if user_info.status_code != 200:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Failed to verify access token")
-
-    playlist = db.query(Playlist).filter(Playlist.id == payload.id).first()
-    if not playlist:
-        return {'message': 'Playlist not found!'}
-
-    track_id = [{'uri': f'spotify:track:{track}'} for track in payload.track_id if len(track) == 22]
-    if not track_id:
-        return {'message': 'No valid track found'}
+    if mode == 'async':
+        return jobs.accepted(await jobs.submit(db, user.id, 'remove', token, payload))
+    return await drop_tracks(db, user, token, payload)
 
-    collab = requests.get(
-        f'https://api.spotify.com/v1/playlists/{payload.id}',
-        headers={'Authorization': f'Bearer {token}'}
-    )
-    if not collab.json().get('collaborative'):
-        if playlist.user_id != user.id:
-            return {'message': 'This playlist is private'}
 
-    remove_track = requests.delete(
-        f'https://api.spotify.com/v1/playlists/{playlist.id}/tracks',
-        headers={'Authorization': f'Bearer {token}',
-                 'Content-Type': 'application/json'
-                 },
-        json={'tracks': track_id}
-    )
+jobs.register('create', new_playlist, PlaylistCreate)
+jobs.register('create_private', new_playlist, PlaylistPrivateCreate)
+jobs.register('alter', add_tracks, AddTrack)
+jobs.register('remove', drop_tracks, AddTrack)
 
-    if remove_track.status_code != 200:
-        raise HTTPException(status_code=remove_track.status_code,
-                            detail=remove_track.json())
 
-    time = requests.get(
-        f'https://api.spotify.com/v1/playlists/{playlist.id}',
-        headers={'Authorization': f'Bearer {token}'}
-    )
+@play.get('/jobs/{job_id}')
+async def get_job(job_id: str,
+                  user: user_dependency,
+                  db: db_dependency,
+                  request: Request,
+                  token: str | None = Cookie(None, alias="access_token")):
+    if not user:
+        return RedirectResponse(url='/user/login')
+    job = await db.get(Job, job_id)
+    if not job or job.user_id != user.id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Job not found')
+    if job.status in (jobs.QUEUED, jobs.RUNNING) and token:
+        # An unfinished job may have lost its token with a restart; polling hands it a current one
+        if await check_expired_token(token):
+            return await refresh_access_token(request, val=None, url=f'/play/jobs/{job_id}')
+        jobs.provide(job.id, token)
+    return jobs.describe(job)
+
+
+@play.put('/alter/time')
+async def reconcile_time(user: user_dependency,
+                         db: db_dependency,
+                         request: Request,
+                         token: str | None = Cookie(None, alias="access_token"),
+                         payload: AlterPlaylist | None = None):
+    if not user or not token:
+        return RedirectResponse(url='/user/login')
+    if await check_expired_token(token):
+        val = json.dumps(payload.dict())
+        return await refresh_access_token(request, val=val, url='/play/alter/time')
 
-    if time.status_code != 200:
-        raise HTTPException(status_code=time.status_code, detail=time.json())
+    if payload is None and request.cookies.get('payload'):
+        payload_j = request.cookies.get('payload')
+        payload = AlterPlaylist(**(json.loads(payload_j)))
 
-    time_sum = sum(item['track']['duration_ms'] for item in time.json()['tracks']['items'])
-    time_sum = time_sum // 1000
+    playlist = await db.get(Playlist, payload.id)
+    if not playlist:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Playlist not found')
 
-    playlist.time = time_sum
-    exist = (db.query(playlist_users).filter(playlist_users.c.playlist_id == playlist.id).
-             filter(playlist_users.c.user_id == user.id).first())
-    if not exist:
-        playlist.users.append(user)
+    playlist.time = await tracks.playlist_duration(playlist.id, token)
     db.add(playlist)
-    db.commit()
-
-    logging.info(f"The playlist: {playlist.id} has been altered by user: {user.id}")
+    await db.commit()
+    await tracks.save_pending(db)
 
-    return {'message': 'Tracks removed from the playlist successfully'}
+    return {'message': 'Playlist duration recounted', 'time': playlist.time}
 
 
 @play.delete('/remove/track')
@@ -488,7 +534,7 @@ async def remove_playlist(user: user_dependency,
                           payload: AlterPlaylist | None = None):
     if not user or not token:
         return RedirectResponse(url='/user/login')
-    if check_expired_token(token):
+    if await check_expired_token(token):
         val = json.dumps(payload.dict())
         return await refresh_access_token(request, val=val, url='/play/remove/track')
 
@@ -496,41 +542,34 @@ async def remove_playlist(user: user_dependency,
         payload_j = request.cookies.get('payload')
         payload = AlterPlaylist(**(json.loads(payload_j)))
 
-    playlist = db.query(Playlist).filter(Playlist.id == payload.id).first()
+    playlist = await db.get(Playlist, payload.id)
     if not playlist:
         return {'message': 'Playlist not found'}
 
-    collab = requests.get(f'https://api.spotify.com/v1/playlists/{playlist.id}',
-                          headers={'Authorization': f'Bearer {token}'})
+    collab = await spotify.api('GET', f'/playlists/{playlist.id}', token)
 
-    if not collab:
+    if collab.status_code != 200:
         raise HTTPException(status_code=collab.status_code, detail=collab.json())
 
     if not collab.json().get('collaborative'):
         if user.id != playlist.user_id:
             raise HTTPException(status_code=403, detail="You don't have permission to delete this playlist")
 
-    remove = requests.delete(f'https://api.spotify.com/v1/playlists/{playlist.id}/followers',
-                             headers={'Authorization': f'Bearer {token}'}
-                             )
+    remove = await spotify.api('DELETE', f'/playlists/{playlist.id}/followers', token)
 
     if remove.status_code == 404:
-        add_user = db.query(UserModel).filter(UserModel.id == user.id).first()
-        if not add_user:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Unauthorized user')
-        add_user.created_playlist -= 1
-
-        db.delete(playlist)
-        db.commit()
+        await db.execute(delete(Playlist).where(Playlist.id == playlist.id))
+        await counters.apply(db, (UserModel.created_playlist, playlist.user_id, -1))
+        await db.commit()
+        invalidate_user(playlist.user_id)
+        playlist_index.remove(playlist.id)
         return {'message': 'Playlist already deleted on spotify'}
     elif remove.status_code == 200:
-        add_user = db.query(UserModel).filter(UserModel.id == user.id).first()
-        if not add_user:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Unauthorized user')
-        add_user.created_playlist -= 1
-
-        db.delete(playlist)
-        db.commit()
+        await db.execute(delete(Playlist).where(Playlist.id == playlist.id))
+        await counters.apply(db, (UserModel.created_playlist, playlist.user_id, -1))
+        await db.commit()
+        invalidate_user(playlist.user_id)
+        playlist_index.remove(playlist.id)
 
         logging.info(f"The playlist: {playlist.id} has been deleted by user: {user.id}")
 
@@ -547,7 +586,7 @@ async def listen(user: user_dependency,
                  payload: Listen | None = None):
     if not user or not token:
         return RedirectResponse(url='/user/login')
-    if check_expired_token(token):
+    if await check_expired_token(token):
         val = json.dumps(payload.dict()) if payload else None
         return await refresh_access_token(request, val=val, url='/play/listen')
 
@@ -555,28 +594,15 @@ async def listen(user: user_dependency,
         payload_j = request.cookies.get('payload')
         payload = Listen(**(json.loads(payload_j)))
 
-    user_info = requests.get(
-        'https://api.spotify.com/v1/me',
-        headers={'Authorization': f'Bearer {token}'}
-    )
-
-    if user_info.status_code != 200:
-        raise HTTPException(status_code=user_info.status_code, detail='Failed to verify access token')
-
-    playlist = requests.get(
-        f'https://api.spotify.com/v1/playlists/{payload.playlist_id}',
-        headers={'Authorization': f'Bearer {token}'}
-    )
+    playlist = await spotify.api('GET', f'/playlists/{payload.playlist_id}', token)
 
     if playlist.status_code != 200:
         raise HTTPException(status_code=playlist.status_code, detail=playlist.json())
+    tracks.remember(item.get('track') for item in playlist.json()['tracks']['items'])
 
-    plays = db.query(Playlist).filter(Playlist.id == payload.playlist_id).first()
-    if plays:
-        plays.plays += 1
-
-        db.add(plays)
-        db.commit()
+    # Counted in memory and written in batches, see schemas/listens.py
+    listens.record(payload.playlist_id)
+    await tracks.save_pending(db)
 
     return {
         "access_token": token,
@@ -586,6 +612,21 @@ async def listen(user: user_dependency,
 
 
 # Users should be able to like, dislike and rate playlist
+async def vote(db, playlist_id: str, user_id: int, table, counter, opposite, opposite_counter):
+    # Primary-key probes on the vote tables instead of loading every liker into memory
+    if not await db.scalar(select(Playlist.id).where(Playlist.id == playlist_id)):
+        raise HTTPException(status_code=404, detail='No playlist with that name')
+
+    added = await db.execute(insert_or_ignore(table).values(playlist_id=playlist_id, user_id=user_id))
+    if not added.rowcount:
+        return
+
+    removed = await db.execute(delete(opposite).where(opposite.c.playlist_id == playlist_id).
+                               where(opposite.c.user_id == user_id))
+    await counters.apply(db, (counter, playlist_id, 1), (opposite_counter, playlist_id, -removed.rowcount))
+    await db.commit()
+
+
 @play.put('/likes')
 async def like_playlist(payload: AlterPlaylist,
                         user: user_dependency,
@@ -593,22 +634,7 @@ async def like_playlist(payload: AlterPlaylist,
     if not user:
         return RedirectResponse(url='/user/login')
 
-    playlist = db.query(Playlist).filter(Playlist.id == payload.id).first()
-
-    if not playlist:
-        raise HTTPException(status_code=404, detail='No playlist with that name')
-
-    if user in playlist.liked_by:
-        return
-    playlist.liked_by.append(user)
-    playlist.likes += 1
-
-    if user in playlist.disliked_by:
-        playlist.disliked_by.remove(user)
-        playlist.dislike -= 1
-
-    db.add(playlist)
-    db.commit()
+    await vote(db, payload.id, user.id, playlist_likes, Playlist.likes, playlist_dislikes, Playlist.dislike)
 
 
 @play.put('/dislike')
@@ -618,51 +644,84 @@ async def dislike_playlist(payload: AlterPlaylist,
     if not user:
         return RedirectResponse(url='/user/login')
 
-    playlist = db.query(Playlist).filter(Playlist.id == payload.id).first()
-
-    if not playlist:
-        raise HTTPException(status_code=404, detail='No playlist with that name')
-
-    if user in playlist.disliked_by:
-        return
-
-    playlist.disliked_by.append(user)
-    playlist.dislike += 1
-
-    if user in playlist.liked_by:
-        playlist.liked_by.remove(user)
-        playlist.likes -= 1
-
-    db.add(playlist)
-    db.commit()
+    await vote(db, payload.id, user.id, playlist_dislikes, Playlist.dislike, playlist_likes, Playlist.likes)
 
 
 @play.get('/discussion', response_model=DiscussionResponse)
 async def get_discussion(payload: AlterPlaylist,
                          user: user_dependency,
-                         db: db_dependency):
+                         db: db_dependency,
+                         limit: int = Query(DISCUSSION_PAGE_SIZE, ge=1, le=100),
+                         order: Literal['asc', 'desc'] = 'asc',
+                         cursor: str | None = None):
     if not user:
         return RedirectResponse(url='/user/login')
 
-    if not db.query(Playlist).filter(Playlist.id == payload.id).first():
+    if not await db.scalar(select(Playlist.id).where(Playlist.id == payload.id)):
         return {'message': 'Playlist not found'}
 
-    discussion = db.query(Discussion).filter(Discussion.playlist_id == payload.id).order_by(
-        asc(Discussion.time_stamp)).all()
+    # Keyset on (time_stamp, id), served by ix_comments_playlist_time in either direction
+    query = select(Discussion).where(Discussion.playlist_id == payload.id)
+    if cursor:
+        (last_id,) = decode_cursor(cursor, 1)
+        if not isinstance(last_id, int):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+        # Compare against the stored time_stamp rather than a round-tripped one, SQLite keeps it as text
+        last_time = select(Discussion.time_stamp).where(Discussion.id == last_id).scalar_subquery()
+        position = tuple_(Discussion.time_stamp, Discussion.id)
+        anchor = tuple_(last_time, last_id)
+        query = query.where(position > anchor if order == 'asc' else position < anchor)
+    sort = asc if order == 'asc' else desc
+    discussion = (await db.scalars(query.order_by(sort(Discussion.time_stamp), sort(Discussion.id)).
+                                   limit(limit + 1))).all()
 
     if not discussion:
         return {'message': 'No comments available for the playlist be the first to comment'}
 
-    comments = []
-    for comment in discussion:
-        discuss = DiscussionReturn(
-            comment=comment.comment,
-            time=comment.time_stamp
-        )
+    next_cursor = None
+    if len(discussion) > limit:
+        next_cursor = encode_cursor(discussion[limit - 1].id)
+
+    comments = [DiscussionReturn(comment=comment.comment, time=comment.time_stamp) for comment in discussion[:limit]]
+
+    return {'comments': comments, 'next_cursor': next_cursor}
 
-        comments.append(discuss)
 
-    return {'comments': comments}
+@play.websocket('/discussion/{playlist_id}/stream')
+async def stream_discussion(websocket: WebSocket,
+                            playlist_id: str,
+                            token: str | None = Cookie(None, alias="jwt_token")):
+    # Short session for the checks only, an open stream must not pin a pooled connection
+    async with session() as db:
+        try:
+            user = await get_user(db, token)
+        except HTTPException:
+            user = None
+        found = await db.scalar(select(Playlist.id).where(Playlist.id == playlist_id))
+    if not isinstance(user, CurrentUser) or not found:
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    subscription = discussions.subscribe(playlist_id)
+
+    async def forward():
+        while (message := await subscription.get()) is not None:
+            await websocket.send_json(message)
+        # Fell a full queue behind, the client reloads /discussion and reconnects
+        await websocket.close(code=1013)
+
+    async def until_disconnect():
+        while (await websocket.receive())['type'] != 'websocket.disconnect':
+            pass
+
+    tasks = {asyncio.create_task(forward()), asyncio.create_task(until_disconnect())}
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        discussions.unsubscribe(subscription)
 
 
 @play.post('/start_discussion')
@@ -672,19 +731,20 @@ async def start_discussion(payload: Comment,
                            ):
     if not user:
         return RedirectResponse(url='/user/login')
-    playlist = db.query(Playlist).filter(Playlist.id == payload.id).first()
-    if not playlist:
+    if not await db.scalar(select(Playlist.id).where(Playlist.id == payload.id)):
         return {'message': 'Playlist not found'}
 
     new_chat = Discussion(
         user_id=user.id,
-        playlist_id=playlist.id,
+        playlist_id=payload.id,
         comment=payload.comment
     )
 
-    playlist.comments += 1
     db.add(new_chat)
-    db.commit()
+    await counters.apply(db, (Playlist.comments, payload.id, 1))
+    await db.commit()
+
+    await discussions.publish(payload.id, {'comment': new_chat.comment, 'time': new_chat.time_stamp.isoformat()})
 
 
 @play.get('/rating')
@@ -694,7 +754,7 @@ async def get_ratings(payload: AlterPlaylist,
     if not user:
         return RedirectResponse(url='/user/login')
 
-    playlist = db.query(Playlist).filter(Playlist.id == payload.id).first()
+    playlist = await db.get(Playlist, payload.id)
 
     if not playlist:
         return {'message': 'Playlist not found'}
@@ -708,62 +768,89 @@ async def add_ratings(payload: Rate,
     if not user:
         return RedirectResponse(url='/user/login')
 
-    playlist = db.query(Playlist).filter(Playlist.id == payload.id).first()
-
-    if not playlist:
+    if not await db.scalar(select(Playlist.id).where(Playlist.id == payload.id)):
         return {'message': 'Playlist not found'}
     if 5.0 < payload.rating or payload.rating < 0.0:
         return {'message': 'Please enter a valid rating on the scale of 0.0 to 5.0'}
 
-    existing_rating = db.query(Rating).filter(Rating.user_id == user.id).filter(
-        Rating.playlist_id == payload.id).first()
-    if not existing_rating:
-        new = Rating(
-            user_id=user.id,
-            playlist_id=playlist.id,
-            rating=payload.rating
-        )
-
-        db.add(new)
-    if existing_rating:
-        existing_rating.rating = payload.rating
-    db.commit()
-
-    count = db.query(Rating).filter(Rating.playlist_id == payload.id).count()
-    avg = db.query(func.sum(Rating.rating)).scalar()
-    avg /= count
-    playlist.rating = avg
-
-    db.add(playlist)
-    db.commit()
+    week = rollups.week_of()
+    added = await db.execute(insert_or_ignore(Rating).values(user_id=user.id, playlist_id=payload.id,
+                                                             rating=payload.rating, week=week))
+    if added.rowcount:
+        await db.execute(counters.rate(payload.id, payload.rating, 1))
+        event = (payload.rating, rollups.RATING)
+    else:
+        # Changing an earlier rating moves the sum by the difference, the count stays
+        previous, previous_week = (await db.execute(
+            select(Rating.rating, Rating.week).where(Rating.user_id == user.id).
+            where(Rating.playlist_id == payload.id).with_for_update())).one()
+        await db.execute(update(Rating).where(Rating.user_id == user.id).where(Rating.playlist_id == payload.id).
+                         values(rating=payload.rating, week=week))
+        await db.execute(counters.rate(payload.id, payload.rating - previous, 0))
+        # The same goes for the week it was counted in; a rating from an earlier week counts anew in this one
+        event = (payload.rating - previous, rollups.RATING_CHANGE) if previous_week == week else \
+            (payload.rating, rollups.RATING)
+    await db.commit()
+    listens.record_rating(payload.id, week, *event)
 
 
 @play.get('/most_vote')
 async def get_most_vote(user: user_dependency,
-                        db: db_dependency):
+                        db: db_dependency,
+                        limit: int = Query(10, ge=1, le=100),
+                        cursor: str | None = None):
     if not user:
         return RedirectResponse(url='/user/login')
 
-    rate = db.query(Playlist).order_by(Playlist.rating.desc()).first()
-    plays = db.query(Playlist).order_by(Playlist.plays.desc()).first()
+    # score is maintained on every rating and plays update, ix_playlist_score serves the order
+    query = select(Playlist)
+    if cursor:
+        last_score, last_id = decode_cursor(cursor, 2)
+        if not isinstance(last_score, (int, float)) or not isinstance(last_id, str):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+        query = query.where(or_(Playlist.score < last_score, and_(Playlist.score == last_score, Playlist.id > last_id)))
+    rows = (await db.scalars(query.order_by(desc(Playlist.score), Playlist.id).limit(limit + 1))).all()
+    next_cursor = encode_cursor(rows[limit - 1].score, rows[limit - 1].id) if len(rows) > limit else None
+
+    playlists = [
+        {
+            'id': playlist.id,
+            'name': playlist.name,
+            'rating': playlist.rating,
+            'plays': playlist.plays,
+            'score': playlist.score
+        }
+        for playlist in rows[:limit]
+    ]
 
-    def compute_score(rating, played, rw=0.85, pw=0.15):
-        return (rating * rw) + (played * pw)
+    return {
+        'top_playlist': playlists[0] if playlists else None,
+        'playlists': playlists,
+        'next_cursor': next_cursor
+    }
 
-    highest_rating = compute_score(rate.rating, rate.plays)
-    highest_play = compute_score(plays.rating, plays.plays)
 
-    if highest_rating > highest_play:
-        playlist = rate
-    else:
-        playlist = plays
+@play.get('/week')
+async def playlist_of_the_week(user: user_dependency,
+                               db: db_dependency,
+                               week: int | None = None,
+                               limit: int = Query(10, ge=1, le=100)):
+    if not user:
+        return RedirectResponse(url='/user/login')
 
-    return {
-        'top_playlist': {
+    week = week or rollups.week_of()
+    playlists = [
+        {
             'id': playlist.id,
             'name': playlist.name,
-            'rating': playlist.rating,
-            'plays': playlist.plays,
-            'score': max(highest_rating, highest_play)
+            'plays': stats.plays,
+            'rating': round(stats.rating_sum / stats.rating_count, 2) if stats.rating_count else 0.0,
+            'score': stats.score
         }
-    }
+        for playlist, stats in await rollups.top_week(db, week, limit)
+    ]
+
+    if not playlists:
+        return {'week': week, 'message': 'No plays or ratings recorded for that week yet'}
+
+    return {'week': week, 'playlists': playlists}
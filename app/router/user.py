@@ -1,21 +1,23 @@
-from fastapi import APIRouter, HTTPException, Request, Cookie
+from fastapi import APIRouter, HTTPException, Request, Cookie, Query
 from fastapi.responses import RedirectResponse, JSONResponse
 from starlette import status
-from dotenv import load_dotenv
-from ..schemas.config import db_dependency, user_dependency, authentication, welcome_email, check_expired_token
+from ..schemas.config import db_dependency, user_dependency, authentication, check_expired_token, invalidate_user, \
+    spotify_ids
+from ..schemas import spotify, counters, outbox, follows
+from ..schemas.pagination import encode_cursor, decode_cursor
+from ..schemas.database import insert_or_ignore
 from ..schemas.user_schemas import *
-from ..schemas.model import UserModel, Following
+from ..schemas.model import UserModel, Following, Playlist
+from ..schemas.trigram import playlist_index
+from sqlalchemy import select, delete
 from datetime import timedelta
 import string
 import random
 import urllib.parse
-import requests
 import os
 import logging
 import base64
 
-load_dotenv()
-
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 user = APIRouter()
@@ -23,6 +25,7 @@ user = APIRouter()
 client_id = os.getenv("CLIENT_ID")
 client_secret = os.getenv("CLIENT_SECRET")
 redirect_uri = os.getenv("REDIRECT_URI")
+FOLLOW_PAGE_SIZE = int(os.getenv('FOLLOW_PAGE_SIZE', 50))
 
 
 @user.get("/login")
@@ -37,12 +40,12 @@ def login(request: Request):
 
     }
     request.session["state"] = state
-    url = f'https://accounts.spotify.com/authorize?{urllib.parse.urlencode(params)}'
+    url = f'{spotify.ACCOUNTS_URL}/authorize?{urllib.parse.urlencode(params)}'
     return RedirectResponse(url)
 
 
 @user.get("/callback", response_model=Token)
-def callback(request: Request, db: db_dependency):
+async def callback(request: Request, db: db_dependency):
     code = request.query_params.get('code')
     state = request.query_params.get('state')
     error = request.query_params.get('error')
@@ -54,8 +57,8 @@ def callback(request: Request, db: db_dependency):
     if valid_state != state:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid State')
 
-    token_request = requests.post(
-        'https://accounts.spotify.com/api/token',
+    token_request = await spotify.accounts(
+        'POST', '/api/token',
         data={
             'code': code,
             'redirect_uri': redirect_uri,
@@ -71,42 +74,44 @@ def callback(request: Request, db: db_dependency):
         token_info = token_request.json()
         token = token_info['access_token']
         refresh_token = token_info['refresh_token']
+        spotify.remember_token(token, token_info.get('expires_in', 3600))
 
-        user_info = requests.get(
-            'https://api.spotify.com/v1/me',
-            headers={
-                'Authorization': f'Bearer {token}'
-            }
-        )
+        user_info = await spotify.api('GET', '/me', token)
 
         if user_info.status_code == 200:
             user_data = user_info.json()
 
-            existing_user = db.query(UserModel).filter(UserModel.email == user_data.get('email')).first()
+            existing_user = await db.scalar(select(UserModel).where(UserModel.email == user_data.get('email')))
             if not existing_user:
                 new_user = UserModel(
                     username=user_data.get('display_name'),
-                    email=user_data.get('email')
+                    email=user_data.get('email'),
+                    spotify_id=user_data.get('id')
                 )
                 db.add(new_user)
-                db.commit()
-                db.refresh(new_user)
+                outbox.welcome(db, user_data.get('email'), user_data.get('display_name'))
+                await db.commit()
+                outbox.notify()
+                await db.refresh(new_user)
 
-                user_det = db.query(UserModel).filter(UserModel.email == user_data.get('email')).first()
+                user_det = await db.scalar(select(UserModel).where(UserModel.email == user_data.get('email')))
 
                 logging.info(f"A new user with id: {user_det.id} and username: {user_det.username} has been created")
 
                 if not user_det:
                     raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Error in handling user info try again')
-                if welcome_email(user_data.get('email'), user_data.get('display_name')):
-                    logging.info(f"The welcome email has been sent to user {user_det.id}")
-                else:
-                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Failed to send welcome email')
+                logging.info(f"The welcome email for user {user_det.id} has been queued")
+            elif existing_user.spotify_id != user_data.get('id'):
+                existing_user.spotify_id = user_data.get('id')
+                db.add(existing_user)
+                await db.commit()
+                invalidate_user(existing_user.id)
+                spotify_ids.pop(existing_user.id, None)
 
         else:
             raise HTTPException(status_code=user_info.status_code, detail='failed to fetch user info')
 
-        get_user_data = db.query(UserModel).filter(UserModel.email == user_data.get('email')).first()
+        get_user_data = await db.scalar(select(UserModel).where(UserModel.email == user_data.get('email')))
         jwt_token = authentication(get_user_data.id, get_user_data.username, timedelta(days=30))
 
         response = RedirectResponse(url='https://dashie-l97z.onrender.com/user/profile')
@@ -161,15 +166,10 @@ async def get_user_profile(db: db_dependency, user: user_dependency, request: Re
     token = request.cookies.get('access_token')
     if not user or not token:
         return {"message": "failed to fetch user info", "token": token, "user": user}
-    if check_expired_token(token):
+    if await check_expired_token(token):
         return await refresh_access_token(request, val=None, url='/user/profile')
 
-    user_info = requests.get(
-        'https://api.spotify.com/v1/me',
-        headers={
-            'Authorization': f'Bearer {token}'
-        }
-    )
+    user_info = await spotify.api('GET', '/me', token)
 
     if user_info.status_code == 200:
         user_data = user_info.json()
@@ -177,13 +177,14 @@ async def get_user_profile(db: db_dependency, user: user_dependency, request: Re
         if email is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Failed to access user email')
 
-        user_db = db.query(UserModel).filter(UserModel.email == email).first()
+        user_db = await db.scalar(select(UserModel).where(UserModel.email == email))
         if user_db is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
         if user_db.username != user_data.get('display_name'):
             user_db.username = user_data.get('display_name')
             db.add(user_db)
-            db.commit()
+            await db.commit()
+            invalidate_user(user_db.id)
 
         profile = {
             'username': user_db.username,
@@ -206,8 +207,8 @@ async def refresh_access_token(request: Request, val, url):
     if not refresh_token:
         return RedirectResponse(url='/user/login')
 
-    new_access_token = requests.post(
-        'https://accounts.spotify.com/api/token',
+    new_access_token = await spotify.accounts(
+        'POST', '/api/token',
         data={
             'grant_type': 'refresh_token',
             'refresh_token': refresh_token,
@@ -220,6 +221,7 @@ async def refresh_access_token(request: Request, val, url):
     if new_access_token.status_code == 200:
         token_info = new_access_token.json()
         access_token = token_info['access_token']
+        spotify.remember_token(access_token, token_info.get('expires_in', 3600))
 
         response = RedirectResponse(url=url)
         response.set_cookie(
@@ -254,28 +256,18 @@ async def follow_user(payload: UserID,
 
     if user.id == payload.id:
         return
-    follow = db.query(UserModel).filter(UserModel.id == payload.id).first()
-    user_detail = db.query(UserModel).filter(UserModel.id == user.id).first()
-    if not follow:
+    if not await db.scalar(select(UserModel.id).where(UserModel.id == payload.id)):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
-    if not user_detail:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Unauthorized user')
-
-    exist = db.query(Following).filter(Following.following == user.id).filter(Following.follower == payload.id).first()
 
-    if exist:
+    # uq_follows_pair turns a repeated follow into a no-op
+    added = await db.execute(insert_or_ignore(Following).values(following=user.id, follower=payload.id))
+    if not added.rowcount:
         return
 
-    new = Following(
-        following=user.id,
-        follower=payload.id
-    )
-
-    user_detail.following += 1
-    follow.followers += 1
-
-    db.add(new)
-    db.commit()
+    await counters.apply(db, (UserModel.following, user.id, 1), (UserModel.followers, payload.id, 1))
+    await db.commit()
+    invalidate_user(user.id, payload.id)
+    follows.followed(user.id, payload.id)
 
 
 @user.put('/unfollow')
@@ -285,40 +277,95 @@ async def unfollow_user(payload: UserID,
     if not user:
         return RedirectResponse(url='/user/login')
 
-    follow = db.query(UserModel).filter(UserModel.id == payload.id).first()
-    user_detail = db.query(UserModel).filter(UserModel.id == user.id).first()
-
-    if not follow:
+    if not await db.scalar(select(UserModel.id).where(UserModel.id == payload.id)):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
-    if not user_detail:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Unauthorized user')
 
-    exist = db.query(Following).filter(Following.following == user.id).filter(Following.follower == payload.id).first()
-    if not exist:
+    removed = await db.execute(delete(Following).where(Following.following == user.id).
+                               where(Following.follower == payload.id))
+    if not removed.rowcount:
         return
-    user_detail.following -= 1
-    follow.followers -= 1
+    await counters.apply(db, (UserModel.following, user.id, -1), (UserModel.followers, payload.id, -1))
+    await db.commit()
+    invalidate_user(user.id, payload.id)
+    follows.unfollowed(user.id, payload.id)
+
+
+async def follow_page(db, direction: str, user_id: int, limit: int, cursor: str | None) -> dict:
+    if not await db.scalar(select(UserModel.id).where(UserModel.id == user_id)):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
+    after = None
+    if cursor:
+        (after,) = decode_cursor(cursor, 1)
+        if not isinstance(after, int):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+
+    ids = await follows.page(db, direction, user_id, after, limit)
+    next_cursor = encode_cursor(ids[limit - 1]) if len(ids) > limit else None
+    ids = ids[:limit]
+    names = dict((await db.execute(select(UserModel.id, UserModel.username).where(UserModel.id.in_(ids)))).all())
+
+    return {'users': [{'id': other, 'username': names[other]} for other in ids if other in names],
+            'next_cursor': next_cursor}
+
+
+@user.get('/{user_id}/followers', response_model=FollowResponse)
+async def get_followers(user_id: int,
+                        user: user_dependency,
+                        db: db_dependency,
+                        limit: int = Query(FOLLOW_PAGE_SIZE, ge=1, le=200),
+                        cursor: str | None = None):
+    if not user:
+        return RedirectResponse(url='/user/login')
+    return await follow_page(db, follows.FOLLOWERS, user_id, limit, cursor)
+
+
+@user.get('/{user_id}/following', response_model=FollowResponse)
+async def get_following(user_id: int,
+                        user: user_dependency,
+                        db: db_dependency,
+                        limit: int = Query(FOLLOW_PAGE_SIZE, ge=1, le=200),
+                        cursor: str | None = None):
+    if not user:
+        return RedirectResponse(url='/user/login')
+    return await follow_page(db, follows.FOLLOWING, user_id, limit, cursor)
+
+
+@user.get('/{user_id}/relationship', response_model=Relationship)
+async def get_relationship(user_id: int,
+                           user: user_dependency,
+                           db: db_dependency):
+    if not user:
+        return RedirectResponse(url='/user/login')
+    if not await db.scalar(select(UserModel.id).where(UserModel.id == user_id)):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
 
-    db.delete(exist)
-    db.commit()
+    following = await follows.follows(db, user.id, user_id)
+    follows_you = await follows.follows(db, user_id, user.id)
+    return {'following': following, 'follows_you': follows_you, 'mutual': following and follows_you}
 
 
 @user.delete('/delete/account')
-def delete_account(user: user_dependency,
-                   db: db_dependency,
-                   message: str):
+async def delete_account(user: user_dependency,
+                         db: db_dependency,
+                         message: str):
     if not user:
         return RedirectResponse(url='/user/login')
 
-    user_acc = db.query(UserModel).filter(UserModel.id == user.id).first()
+    user_acc = await db.get(UserModel, user.id)
     if not user_acc:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
 
     if message.strip() != f'I {user_acc.username} want to delete my account':
         return {'message': 'Invalid confirmation message'}
 
-    db.delete(user_acc)
-    db.commit()
+    # The account's playlists go with it (ON DELETE CASCADE), so they leave the search index too
+    playlist_ids = list(await db.scalars(select(Playlist.id).where(Playlist.user_id == user_acc.id)))
+    await db.execute(delete(UserModel).where(UserModel.id == user_acc.id))
+    await db.commit()
+    invalidate_user(user_acc.id)
+    follows.forget(user_acc.id)
+    for playlist_id in playlist_ids:
+        playlist_index.remove(playlist_id)
 
     logging.info(f"User account with id: {user_acc.id} and username: {user_acc.username} has been deleted.")
     response = RedirectResponse(url='/', status_code=status.HTTP_303_SEE_OTHER)
@@ -0,0 +1,106 @@
+import os
+import time
+import asyncio
+from collections import defaultdict, deque
+from typing import Callable
+from . import metrics
+
+QUEUE_SIZE = int(os.getenv('DISCUSSION_QUEUE_SIZE', 100))
+
+
+class Subscription:
+    __slots__ = ('topic', 'size', 'messages', 'ready', 'overflowed')
+
+    def __init__(self, topic: str, size: int):
+        self.topic = topic
+        self.size = size
+        self.messages = deque()
+        self.ready = asyncio.Event()
+        self.overflowed = False
+
+    def push(self, message) -> bool:
+        if len(self.messages) >= self.size:
+            self.overflowed = True
+            self.ready.set()
+            return False
+        self.messages.append(message)
+        self.ready.set()
+        return True
+
+    async def get(self):
+        # None once the client fell a full queue behind; it should resync from /discussion
+        while not self.messages and not self.overflowed:
+            self.ready.clear()
+            await self.ready.wait()
+        if self.overflowed:
+            return None
+        return self.messages.popleft()
+
+
+class LocalTransport:
+    # Delivers inside this process only. A cross-worker transport (Redis pub/sub, Postgres
+    # LISTEN/NOTIFY) has the same methods and calls deliver for messages published by any worker
+    def bind(self, deliver: Callable[[str, dict], None]):
+        self._deliver = deliver
+
+    async def publish(self, topic: str, message: dict):
+        self._deliver(topic, message)
+
+    async def close(self):
+        pass
+
+
+class Broker:
+    def __init__(self, name: str, transport=None, queue_size: int = QUEUE_SIZE):
+        self._topics: defaultdict[str, set[Subscription]] = defaultdict(set)
+        self.queue_size = queue_size
+        self.transport = transport or LocalTransport()
+        self.transport.bind(self._deliver)
+        self.published = 0
+        self.delivered = 0
+        self.overflowed = 0
+        self.last_fanout_seconds = 0.0
+        metrics.register(name, self.stats)
+
+    def subscribe(self, topic: str) -> Subscription:
+        subscription = Subscription(topic, self.queue_size)
+        self._topics[topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._topics.get(subscription.topic)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._topics[subscription.topic]
+
+    async def publish(self, topic: str, message: dict):
+        self.published += 1
+        await self.transport.publish(topic, message)
+
+    def _deliver(self, topic: str, message: dict):
+        # Never waits on a subscriber: a full queue drops that client instead of slowing the rest
+        start = time.perf_counter()
+        for subscription in list(self._topics.get(topic, ())):
+            if subscription.push(message):
+                self.delivered += 1
+            else:
+                self.overflowed += 1
+                self.unsubscribe(subscription)
+        self.last_fanout_seconds = round(time.perf_counter() - start, 6)
+
+    async def close(self):
+        await self.transport.close()
+
+    def stats(self) -> dict:
+        return {
+            'topics': len(self._topics),
+            'subscribers': sum(len(subscribers) for subscribers in self._topics.values()),
+            'published': self.published,
+            'delivered': self.delivered,
+            'overflowed': self.overflowed,
+            'last_fanout_seconds': self.last_fanout_seconds,
+        }
+
+
+discussions = Broker('discussion_stream')
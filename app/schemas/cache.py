@@ -0,0 +1,62 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable
+from cachetools import TTLCache
+from . import metrics
+
+
+class CoalescingCache:
+    # TTL cache where concurrent misses on the same key share one load ("singleflight")
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.retried = 0
+        metrics.register(name, self.stats)
+
+    async def get(self, key: Hashable, load: Callable[[], Awaitable]):
+        if key in self._cache:
+            self.hits += 1
+            return self._cache[key]
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(key, load))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+            return await asyncio.shield(task)
+
+        self.coalesced += 1
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            # Only successes are shared: the first caller may have failed on something of its own, like an
+            # expired token, so each waiter tries again with its own load
+            self.retried += 1
+            return await self._load(key, load)
+
+    async def _load(self, key, load):
+        value = await load()
+        self._cache[key] = value
+        return value
+
+    def _finish(self, key, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            # Mark the error as seen even if every waiter went away
+            task.exception()
+
+    def stats(self) -> dict:
+        served = self.hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'retried': self.retried,
+            'hit_ratio': round((self.hits + self.coalesced - self.retried) / served, 4) if served else 0.0,
+            'upstream_calls': self.misses + self.retried,
+            'upstream_calls_saved': self.hits + self.coalesced - self.retried,
+            'size': len(self._cache),
+        }
@@ -1,29 +1,27 @@
 import os
-import requests
 from fastapi.responses import RedirectResponse
-from .database import begin
+from .database import session
 from .model import UserModel
+from . import spotify
 from jose import JWTError, jwt
 from typing import Annotated
 from fastapi import Depends, HTTPException, Cookie
-from sqlalchemy.orm import Session
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
 from starlette import status
-from postmarker.core import PostmarkClient
+from cachetools import LRUCache, TTLCache
+from .user_schemas import CurrentUser
+from . import metrics
 
 
-def get_db():
-    db = begin()
-    try:
+async def get_db():
+    async with session() as db:
         yield db
-    finally:
-        db.close()
 
 
 secret = os.getenv('SECRET')
 Algorithm = os.getenv('ALGORITHM')
-conf = os.getenv('FROM')
-postmark = PostmarkClient(server_token=os.getenv('POSTMARK'))
 
 
 def authentication(user_id: int, username: str, limit):
@@ -33,7 +31,17 @@ def authentication(user_id: int, username: str, limit):
     return jwt.encode(encode, secret, algorithm=Algorithm)
 
 
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
+
+# Detached snapshots of authenticated users, dropped by the handlers that change them
+user_cache = TTLCache(maxsize=int(os.getenv('USER_CACHE_SIZE', 10000)), ttl=int(os.getenv('USER_CACHE_TTL', 300)))
+user_cache_stats = {'hits': 0, 'misses': 0}
+metrics.register('user_cache', lambda: {**user_cache_stats, 'size': len(user_cache)})
+
+
+def invalidate_user(*user_ids: int):
+    for user_id in user_ids:
+        user_cache.pop(user_id, None)
 
 
 async def get_user(db: db_dependency, token: str | None = Cookie(None, alias="jwt_token")):
@@ -53,54 +61,55 @@ async def get_user(db: db_dependency, token: str | None = Cookie(None, alias="jw
         if exp and datetime.utcnow() > exp:
             return RedirectResponse(url='/user/login')
 
-        user = db.query(UserModel).filter(UserModel.id == user_id).first()
-        if user is None:
+        user = user_cache.get(user_id)
+        if user is not None:
+            user_cache_stats['hits'] += 1
+            return user
+
+        user_cache_stats['misses'] += 1
+        user_db = await db.get(UserModel, user_id)
+        if user_db is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        user = CurrentUser.model_validate(user_db)
+        user_cache[user_id] = user
         return user
     except JWTError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"An error occurred as {e}")
 
 
-def welcome_email(user_email, user_firstname):
-    response = postmark.emails.send(
-        From=conf,
-        To=user_email,
-        Subject='Welcome To Dashie',
-        HtmlBody=(f'''
-    <div style="font-family: Arial, sans-serif; color: #333; background-color: #f0f4f8; padding: 20px; border-radius: 10px; text-align: center;">
-        <h3 style="color: #4caf50;">🎉 Hey, {user_firstname}! 🎉</h3>
-        <p style="font-size: 15px;">
-            We are pleased to have you onboard, Welcome to a great experience Buckle up cause listening to music has not been this fun.
-        </p>
-        <p style="font-size: 15px; margin-top: 10px;">
-            We are streaming platform that allow for listeners like you to not only play music but also be able to share your experience with your friends by collaborating to create playlist together and so much more
-        </p>
-        <div style="margin-top: 15px;">
-            <a href="https://spotify-dv92.onrender.com/user/login" style="text-decoration: none; background-color: #4caf50; color: green; padding: 10px 20px; border-radius: 5px; font-size: 15px;">Begin your journey</a>
-        </div>
-        <p style="font-size: 14px; color: #757575; margin-top: 20px;">
-            Once again Welcome,<br/>
-            <strong>Dashie</strong>
-        </p>
-    </div>
-'''),
-        TextBody=f'Hey {user_firstname},\n We are pleased to have you onboard, Welcome to a great experience Buckle up cause listening to music has not been this fun.\n We are streaming platform that allow for listeners like you to not only play music but also'
-                 f'be able to share your experience with your friends by collaborating to create playlist together and so much more.\n\n\n Once again Welcome to Dashie \n You can begin your journey here https://spotify-dv92.onrender.com/user/login',
-        MessageStream='outbound'
-
-    )
-
-    if response['ErrorCode'] == 0:
-        return True
-    else:
+user_dependency = Annotated[CurrentUser, Depends(get_user)]
+
+
+async def check_expired_token(token: str):
+    if spotify.token_known_valid(token):
         return False
 
+    # Tokens we did not issue in this worker (or whose expiry we lost) are probed once and trusted briefly
+    exp = await spotify.api('GET', '/me', token)
+    if exp.status_code == 401:
+        return True
+    spotify.remember_token(token, spotify.TOKEN_PROBE_TTL)
+    return False
+
+
+# Local user id -> Spotify user id, so mutations don't need a /v1/me round trip
+spotify_ids = LRUCache(maxsize=int(os.getenv('SPOTIFY_ID_CACHE_SIZE', 10000)))
 
-user_dependency = Annotated[Session, Depends(get_user)]
 
+async def get_spotify_id(user, db, token: str):
+    spotify_id = spotify_ids.get(user.id) or user.spotify_id
+    if spotify_id is None:
+        # Accounts created before the spotify id was stored at login
+        user_info = await spotify.api('GET', '/me', token)
+        if user_info.status_code != 200:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Failed to verify access token')
+        spotify_id = user_info.json().get('id')
+        if not spotify_id:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='User Id not found')
 
-def check_expired_token(token: str):
-    exp = requests.get("https://api.spotify.com/v1/me",
-                       headers={'Authorization': f'Bearer {token}'})
+        await db.execute(update(UserModel).where(UserModel.id == user.id).values(spotify_id=spotify_id))
+        await db.commit()
+        invalidate_user(user.id)
 
-    return exp.status_code == 401
+    spotify_ids[user.id] = spotify_id
+    return spotify_id
@@ -0,0 +1,102 @@
+import logging
+from collections import defaultdict
+
+if __name__ == '__main__':
+    # The backfill script, run outside the app: the weights below may come from .env
+    from dotenv import load_dotenv
+    load_dotenv()
+
+from sqlalchemy import update, select, case, func, or_  # noqa: E402
+from .database import get_engine  # noqa: E402
+from .model import UserModel, Playlist, Following, Discussion, Rating, playlist_likes, playlist_dislikes  # noqa: E402
+
+
+def statements(*changes):
+    # changes are (column, primary key, delta); one UPDATE per table, one CASE per column
+    tables = defaultdict(lambda: defaultdict(dict))
+    for column, key, delta in changes:
+        if not delta:
+            continue
+        column = column.property.columns[0] if hasattr(column, 'property') else column
+        deltas = tables[column.table][column]
+        deltas[key] = deltas.get(key, 0) + delta
+
+    for table, columns in tables.items():
+        pk = table.primary_key.columns[0]
+        keys = {key for deltas in columns.values() for key in deltas}
+        values = {column: column + case(deltas, value=pk, else_=0) for column, deltas in columns.items()}
+        yield update(table).where(pk.in_(keys)).values(values)
+
+
+async def apply(db, *changes):
+    # Runs in the caller's transaction, commit stays with the caller
+    for statement in statements(*changes):
+        await db.execute(statement)
+
+
+def _count(column, key):
+    return select(func.count()).where(column == key).scalar_subquery()
+
+
+RATING_WEIGHT = 0.85
+PLAYS_WEIGHT = 0.15
+
+
+def score(rating, plays):
+    return func.coalesce(rating, 0.0) * RATING_WEIGHT + plays * PLAYS_WEIGHT
+
+
+def rate(playlist_id: str, delta: float, added: int):
+    # New average from the stored aggregate; SET reads the pre-update values on both backends
+    rating_sum = Playlist.rating_sum + delta
+    rating_count = Playlist.rating_count + added
+    rating = case((rating_count > 0, rating_sum / rating_count), else_=0.0)
+    return update(Playlist).where(Playlist.id == playlist_id).values(
+        rating_sum=rating_sum,
+        rating_count=rating_count,
+        rating=rating,
+        score=score(rating, Playlist.plays),
+    )
+
+
+_rating_sum = (select(func.coalesce(func.sum(Rating.rating), 0.0)).
+               where(Rating.playlist_id == Playlist.id).scalar_subquery())
+_rating_count = _count(Rating.playlist_id, Playlist.id)
+_rating = case((_rating_count > 0, _rating_sum / _rating_count), else_=0.0)
+
+
+# Every denormalized counter and the set-based expression it should equal
+EXPECTED = {
+    UserModel.__table__: {
+        'created_playlist': _count(Playlist.user_id, UserModel.id),
+        'followers': _count(Following.follower, UserModel.id),
+        'following': _count(Following.following, UserModel.id),
+    },
+    Playlist.__table__: {
+        'likes': _count(playlist_likes.c.playlist_id, Playlist.id),
+        'dislike': _count(playlist_dislikes.c.playlist_id, Playlist.id),
+        'comments': _count(Discussion.playlist_id, Playlist.id),
+        'rating_sum': _rating_sum,
+        'rating_count': _rating_count,
+        'rating': _rating,
+        'score': score(_rating, Playlist.plays),
+    },
+}
+
+
+def reconcile(conn) -> dict[str, int]:
+    fixed = {}
+    for table, expected in EXPECTED.items():
+        drifted = or_(*(table.c[name] != value for name, value in expected.items()))
+        fixed[table.name] = conn.execute(update(table).where(drifted).values(expected)).rowcount
+    return fixed
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    from .migrations import upgrade
+    # The rating and score columns this writes are added by a migration; apply any still pending first
+    logging.info(f"{upgrade()} pending migrations applied")
+    with get_engine().begin() as conn:
+        for name, rows in reconcile(conn).items():
+            logging.info(f"Reconciled counters on {name}: {rows} rows corrected")
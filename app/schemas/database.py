@@ -1,11 +1,232 @@
 import os
-from dotenv import load_dotenv
-from sqlalchemy import create_engine
+import time
+from contextlib import asynccontextmanager
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import Engine, make_url, URL
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine
 from sqlalchemy.orm import declarative_base, sessionmaker
-
-load_dotenv()
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from starlette.concurrency import run_in_threadpool
+from . import metrics
 
 DATABASE_URL = os.getenv('DATABASE_URL')
-engine = create_engine(DATABASE_URL)
-begin = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+# Routers talk to AsyncSession; DB_ASYNC=false runs the same calls on sync sessions in the threadpool
+DB_ASYNC = os.getenv('DB_ASYNC', 'true').lower() in ('1', 'true', 'yes')
+
+_ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+
+def async_url(url: str) -> URL:
+    url = make_url(url)
+    driver = _ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None or url.drivername == driver:
+        return url
+    if driver == 'postgresql+asyncpg' and 'sslmode' in url.query:
+        # asyncpg spells libpq's sslmode as ssl
+        url = url.update_query_dict({'ssl': url.query['sslmode']}).difference_update_query(['sslmode'])
+    return url.set(drivername=driver)
+
+
+def dialect_insert(table):
+    # INSERT with the ON CONFLICT extensions of whichever dialect DATABASE_URL points at
+    dialect = postgresql if make_url(DATABASE_URL).get_backend_name() == 'postgresql' else sqlite
+    return dialect.insert(table)
+
+
+def insert_or_ignore(table):
+    return dialect_insert(table).on_conflict_do_nothing()
+
+
+@event.listens_for(Engine, 'connect')
+def _sqlite_foreign_keys(dbapi_connection, _):
+    # SQLite ignores ON DELETE CASCADE unless asked, Postgres always honours it
+    if 'sqlite' in type(dbapi_connection).__module__:
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.overflow_events = 0
+        self.timeouts = 0
+
+    def record(self, waited: float, overflowed: bool):
+        self.checkouts += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        if overflowed:
+            self.overflow_events += 1
+
+
+pool_stats = {'sync': PoolStats(), 'async': PoolStats()}
+
+
+def _instrumented(base, stats: PoolStats):
+    class InstrumentedPool(base):
+        def connect(self):
+            start = time.perf_counter()
+            overflow = self.overflow()
+            try:
+                return super().connect()
+            except exc.TimeoutError:
+                stats.timeouts += 1
+                raise
+            finally:
+                after = self.overflow()
+                stats.record(time.perf_counter() - start, after > 0 and after > overflow)
+
+    return InstrumentedPool
+
+
+def _pool_options(url, base, stats: PoolStats) -> dict:
+    options = {'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')}
+    if make_url(url).get_backend_name() == 'sqlite':
+        # Local SQLite keeps the dialect's default pool
+        return options
+    return {
+        **options,
+        'poolclass': _instrumented(base, stats),
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+    }
+
+
+# Engines are built on first use, so importing the app never loads a DB driver or sizes a pool
+_engine = None
+_async_engine = None
+_begin = None
+_async_begin = None
+
+
+def get_engine() -> Engine:
+    global _engine, _begin
+    if _engine is None:
+        _engine = create_engine(DATABASE_URL, **_pool_options(DATABASE_URL, QueuePool, pool_stats['sync']))
+        _begin = sessionmaker(bind=_engine, autoflush=False, autocommit=False, expire_on_commit=False)
+    return _engine
+
+
+def get_async_engine() -> AsyncEngine:
+    global _async_engine, _async_begin
+    if _async_engine is None:
+        _async_engine = create_async_engine(async_url(DATABASE_URL),
+                                            **_pool_options(DATABASE_URL, AsyncAdaptedQueuePool, pool_stats['async']))
+        _async_begin = async_sessionmaker(bind=_async_engine, autoflush=False, autocommit=False,
+                                          expire_on_commit=False)
+    return _async_engine
+
+
+def __getattr__(name):
+    # Keeps `from .database import engine` (and the session factories) working for scripts and benchmarks
+    if name == 'engine':
+        return get_engine()
+    if name == 'async_engine':
+        return get_async_engine()
+    if name == 'begin':
+        get_engine()
+        return _begin
+    if name == 'async_begin':
+        get_async_engine()
+        return _async_begin
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+async def close_engines():
+    global _engine, _async_engine
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+    if _engine is not None:
+        _engine.dispose()
+        _engine = None
+
+
 data = declarative_base()
+
+
+def _pool_report(pool, stats: PoolStats) -> dict:
+    report = {'status': pool.status()}
+    if isinstance(pool, QueuePool):
+        report.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'idle': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+        })
+    report.update({
+        'checkouts': stats.checkouts,
+        'wait_avg_ms': round(stats.wait_total / stats.checkouts * 1000, 3) if stats.checkouts else 0.0,
+        'wait_max_ms': round(stats.wait_max * 1000, 3),
+        'overflow_events': stats.overflow_events,
+        'timeouts': stats.timeouts,
+    })
+    return report
+
+
+metrics.register('db_pool', lambda: {
+    'sync': _pool_report(_engine.pool, pool_stats['sync']) if _engine else None,
+    'async': _pool_report(_async_engine.sync_engine.pool, pool_stats['async']) if _async_engine else None,
+})
+
+
+@asynccontextmanager
+async def session():
+    if DB_ASYNC:
+        get_async_engine()
+        async with _async_begin() as db:
+            yield db
+        return
+
+    get_engine()
+    db = ThreadedSession(_begin())
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+class ThreadedSession:
+    """The subset of the AsyncSession API the routers use, backed by a sync Session run in the threadpool."""
+
+    def __init__(self, session):
+        self.sync_session = session
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    async def execute(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.execute, *args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalar, *args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalars, *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.get, *args, **kwargs)
+
+    async def refresh(self, instance):
+        await run_in_threadpool(self.sync_session.refresh, instance)
+
+    async def delete(self, instance):
+        await run_in_threadpool(self.sync_session.delete, instance)
+
+    async def flush(self):
+        await run_in_threadpool(self.sync_session.flush)
+
+    async def commit(self):
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self.sync_session.rollback)
+
+    async def close(self):
+        await run_in_threadpool(self.sync_session.close)
@@ -0,0 +1,120 @@
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from cachetools import TTLCache
+from sqlalchemy import select
+from .model import UserModel, Following
+from . import metrics
+
+# A row (following=A, follower=B) means A follows B
+CACHE_EDGES = int(os.getenv('FOLLOW_CACHE_EDGES', 2000000))
+CACHE_TTL = int(os.getenv('FOLLOW_CACHE_TTL', 300))
+# Users with more edges than this are paged straight from the indexes instead of being loaded whole
+MAX_DEGREE = int(os.getenv('FOLLOW_CACHE_MAX_DEGREE', 100000))
+
+FOLLOWING, FOLLOWERS = 'following', 'followers'
+
+# Sorted ids per user, sized by edge count. The TTL bounds staleness from follows made on other workers
+_cache = {
+    FOLLOWING: TTLCache(maxsize=CACHE_EDGES, ttl=CACHE_TTL, getsizeof=lambda ids: len(ids) + 1),
+    FOLLOWERS: TTLCache(maxsize=CACHE_EDGES, ttl=CACHE_TTL, getsizeof=lambda ids: len(ids) + 1),
+}
+# direction -> (column holding the user, column holding the other side, counter on UserModel)
+_columns = {
+    FOLLOWING: (Following.following, Following.follower, UserModel.following),
+    FOLLOWERS: (Following.follower, Following.following, UserModel.followers),
+}
+follow_cache_stats = {'hits': 0, 'misses': 0, 'uncached': 0}
+metrics.register('follow_cache', lambda: {
+    **follow_cache_stats,
+    'users': sum(len(cache) for cache in _cache.values()),
+    'edges': sum(cache.currsize for cache in _cache.values()),
+})
+
+
+def _store(direction: str, user_id: int, ids: array):
+    try:
+        _cache[direction][user_id] = ids
+    except ValueError:
+        # Larger than the whole cache
+        _cache[direction].pop(user_id, None)
+
+
+async def _adjacency(db, direction: str, user_id: int) -> array | None:
+    # The full sorted id list for a cacheable user, None when the user is too big to hold in memory
+    ids = _cache[direction].get(user_id)
+    if ids is not None:
+        follow_cache_stats['hits'] += 1
+        return ids
+    own, other, counter = _columns[direction]
+    if (await db.scalar(select(counter).where(UserModel.id == user_id)) or 0) > MAX_DEGREE:
+        follow_cache_stats['uncached'] += 1
+        return None
+    follow_cache_stats['misses'] += 1
+    ids = array('q', await db.scalars(select(other).where(own == user_id).order_by(other)))
+    _store(direction, user_id, ids)
+    return ids
+
+
+async def page(db, direction: str, user_id: int, after: int | None, limit: int) -> list[int]:
+    # limit + 1 ids in ascending order, so the caller can tell whether there is a next page
+    ids = await _adjacency(db, direction, user_id)
+    if ids is not None:
+        start = bisect_right(ids, after) if after is not None else 0
+        return list(ids[start:start + limit + 1])
+    own, other, _ = _columns[direction]
+    query = select(other).where(own == user_id)
+    if after is not None:
+        query = query.where(other > after)
+    return list(await db.scalars(query.order_by(other).limit(limit + 1)))
+
+
+def _contains(ids: array, user_id: int) -> bool:
+    at = bisect_left(ids, user_id)
+    return at < len(ids) and ids[at] == user_id
+
+
+async def follows(db, user_id: int, other_id: int) -> bool:
+    for direction, owner, member in ((FOLLOWING, user_id, other_id), (FOLLOWERS, other_id, user_id)):
+        ids = _cache[direction].get(owner)
+        if ids is not None:
+            follow_cache_stats['hits'] += 1
+            return _contains(ids, member)
+    # Neither side is cached; a single probe of uq_follows_pair
+    follow_cache_stats['misses'] += 1
+    return await db.scalar(select(Following.id).where(Following.following == user_id).
+                           where(Following.follower == other_id)) is not None
+
+
+def _insert(direction: str, owner: int, member: int):
+    ids = _cache[direction].get(owner)
+    if ids is not None and not _contains(ids, member):
+        ids.insert(bisect_left(ids, member), member)
+        # Re-set so the cache accounts for the new size
+        _store(direction, owner, ids)
+
+
+def _remove(direction: str, owner: int, member: int):
+    ids = _cache[direction].get(owner)
+    if ids is not None and _contains(ids, member):
+        del ids[bisect_left(ids, member)]
+        _store(direction, owner, ids)
+
+
+def followed(user_id: int, other_id: int):
+    _insert(FOLLOWING, user_id, other_id)
+    _insert(FOLLOWERS, other_id, user_id)
+
+
+def unfollowed(user_id: int, other_id: int):
+    _remove(FOLLOWING, user_id, other_id)
+    _remove(FOLLOWERS, other_id, user_id)
+
+
+def forget(user_id: int):
+    # Account deleted: its own lists and every cached list it appears in
+    for direction, cache in _cache.items():
+        cache.pop(user_id, None)
+        for owner, ids in list(cache.items()):
+            if _contains(ids, user_id):
+                _remove(direction, owner, user_id)
@@ -0,0 +1,191 @@
+import os
+import json
+import uuid
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Callable
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from sqlalchemy import select, update, or_, and_
+from starlette import status
+from .database import session
+from .model import Job, UserModel
+from .user_schemas import CurrentUser
+from . import metrics
+
+WORKERS = int(os.getenv('JOB_WORKERS', 4))
+POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 2))
+# A running job renews its lease; once it lapses (the process died) any worker holding its token picks it up again
+LEASE = timedelta(seconds=int(os.getenv('JOB_LEASE', 60)))
+MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+# kind -> (service function, payload model)
+_handlers: dict[str, tuple[Callable, type[BaseModel]]] = {}
+_running: dict[str, asyncio.Task] = {}
+_wake: asyncio.Event | None = None
+# job id -> the owner's Spotify token, held in memory only. A worker claims just the jobs it holds a token for;
+# one left over from a dead process waits for its owner's next status poll to hand a fresh one in
+_tokens: dict[str, str] = {}
+
+job_stats = {'submitted': 0, 'resumed': 0, 'done': 0, 'failed': 0}
+metrics.register('jobs', lambda: {**job_stats, 'running': len(_running), 'held_tokens': len(_tokens),
+                                  'workers': WORKERS})
+
+
+def register(kind: str, handler: Callable, payload_model: type[BaseModel]):
+    # handler(db, user, token, payload, progress, report) is the same service function the sync endpoint calls
+    _handlers[kind] = (handler, payload_model)
+
+
+def notify():
+    if _wake is not None:
+        _wake.set()
+
+
+async def submit(db, user_id: int, kind: str, token: str, payload: BaseModel) -> Job:
+    job = Job(id=uuid.uuid4().hex, user_id=user_id, kind=kind, status=QUEUED,
+              payload=payload.model_dump_json(), progress='{}')
+    db.add(job)
+    await db.commit()
+    job_stats['submitted'] += 1
+    provide(job.id, token)
+    return job
+
+
+def provide(job_id: str, token: str):
+    _tokens[job_id] = token
+    notify()
+
+
+def accepted(job: Job) -> JSONResponse:
+    url = f'/play/jobs/{job.id}'
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, headers={'Location': url},
+                        content={'job_id': job.id, 'status': job.status, 'status_url': url})
+
+
+def describe(job: Job) -> dict:
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': json.loads(job.progress or '{}'),
+        'result': json.loads(job.result) if job.result else None,
+        'error': json.loads(job.error) if job.error else None,
+        'attempts': job.attempts,
+        'created_at': job.created_at,
+        'updated_at': job.updated_at,
+    }
+
+
+async def _save(job_id: str, **values):
+    async with session() as db:
+        await db.execute(update(Job).where(Job.id == job_id).values(updated_at=datetime.utcnow(), **values))
+        await db.commit()
+
+
+async def _claim(limit: int) -> list[str]:
+    held = [job_id for job_id in _tokens if job_id not in _running]
+    if not held:
+        return []
+    now = datetime.utcnow()
+    due = and_(Job.id.in_(held), or_(Job.status == QUEUED, and_(Job.status == RUNNING, Job.lease_until < now)))
+    claimed = []
+    async with session() as db:
+        # Tokens handed in for jobs another worker has since finished (or that were deleted) are let go
+        unfinished = set(await db.scalars(select(Job.id).where(Job.id.in_(held)).
+                                          where(Job.status.in_((QUEUED, RUNNING)))))
+        for job_id in held:
+            if job_id not in unfinished:
+                _tokens.pop(job_id, None)
+        candidates = list(await db.scalars(
+            select(Job.id).where(due).order_by(Job.created_at).limit(limit).with_for_update(skip_locked=True)))
+        for job_id in candidates:
+            # Conditional, so two processes racing for the same row can't both win it
+            won = await db.execute(update(Job).where(Job.id == job_id).where(due).
+                                   values(status=RUNNING, lease_until=now + LEASE, attempts=Job.attempts + 1))
+            if won.rowcount:
+                claimed.append(job_id)
+        await db.commit()
+    return claimed
+
+
+async def _heartbeat(job_id: str):
+    while True:
+        await asyncio.sleep(LEASE.total_seconds() / 3)
+        await _save(job_id, lease_until=datetime.utcnow() + LEASE)
+
+
+async def _run(job_id: str):
+    heartbeat = asyncio.create_task(_heartbeat(job_id))
+    progress = {}
+    try:
+        async with session() as db:
+            job = await db.get(Job, job_id)
+            progress = json.loads(job.progress or '{}')
+            if job.attempts > 1:
+                job_stats['resumed'] += 1
+            if job.attempts > MAX_ATTEMPTS:
+                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                                    detail=f'Gave up after {MAX_ATTEMPTS} attempts')
+
+            async def report(**fields):
+                progress.update(fields)
+                await _save(job_id, progress=json.dumps(progress))
+
+            handler, payload_model = _handlers[job.kind]
+            user = CurrentUser.model_validate(await db.get(UserModel, job.user_id))
+            result = await handler(db, user, _tokens[job_id], payload_model.model_validate_json(job.payload),
+                                   progress, report)
+        values = {'status': DONE, 'result': json.dumps(result, default=str)}
+    except HTTPException as e:
+        values = {'status': FAILED, 'error': json.dumps({'status_code': e.status_code, 'detail': e.detail}, default=str)}
+    except asyncio.CancelledError:
+        # Shutting down: hand the job straight back to the queue instead of waiting out the lease
+        heartbeat.cancel()
+        await _save(job_id, status=QUEUED, lease_until=None, progress=json.dumps(progress))
+        raise
+    except Exception:
+        logging.exception(f"Job {job_id} failed")
+        values = {'status': FAILED, 'error': json.dumps({'status_code': 500, 'detail': 'Internal error'})}
+    heartbeat.cancel()
+    job_stats[values['status']] += 1
+    await _save(job_id, lease_until=None, progress=json.dumps(progress), **values)
+    logging.info(f"Job {job_id} finished as {values['status']}")
+
+
+def _finished(job_id: str):
+    _running.pop(job_id, None)
+    _tokens.pop(job_id, None)
+    notify()
+
+
+async def job_loop():
+    # Jobs left queued or running by a previous process are claimed here too, once their owner polls: that is the
+    # resume
+    global _wake
+    _wake = asyncio.Event()
+    while True:
+        _wake.clear()
+        free = WORKERS - len(_running)
+        if free > 0:
+            try:
+                for job_id in await _claim(free):
+                    _running[job_id] = asyncio.create_task(_run(job_id))
+                    _running[job_id].add_done_callback(lambda _, job_id=job_id: _finished(job_id))
+            except Exception:
+                logging.exception("Failed to claim jobs")
+        try:
+            await asyncio.wait_for(_wake.wait(), POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def close():
+    tasks = list(_running.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,122 @@
+import os
+import time
+import asyncio
+import logging
+from collections import defaultdict
+from sqlalchemy import update, insert, bindparam
+from .database import session
+from .model import Playlist, PlaylistEvent
+from .counters import score
+from .rollups import week_of, LISTEN, RATING
+from . import metrics
+
+FLUSH_INTERVAL = float(os.getenv('PLAYS_FLUSH_INTERVAL', 5))
+
+# Listens not yet written to the playlist table, per (playlist id, week)
+_pending: defaultdict[tuple[str, int], int] = defaultdict(int)
+# Ratings not yet written to the event log, as (playlist id, week, kind, value)
+_ratings: list[tuple[str, int, int, float]] = []
+# When the oldest listen in _pending was recorded (monotonic), None while empty
+_oldest: float | None = None
+
+flush_stats = {'flushes': 0, 'failed_flushes': 0, 'plays_flushed': 0, 'last_flush_seconds': 0.0}
+
+_playlist = Playlist.__table__
+_add_plays = (update(_playlist)
+              .where(_playlist.c.id == bindparam('playlist_id'))
+              .values(plays=_playlist.c.plays + bindparam('count'),
+                      score=score(_playlist.c.rating, _playlist.c.plays + bindparam('count'))))
+
+
+def record(playlist_id: str):
+    global _oldest
+    if _oldest is None:
+        _oldest = time.monotonic()
+    _pending[playlist_id, week_of()] += 1
+
+
+def record_rating(playlist_id: str, week: int, value: float, kind: int = RATING):
+    # The playlist aggregate is updated by the request itself, this only feeds the weekly log
+    _ratings.append((playlist_id, week, kind, value))
+
+
+def pending() -> int:
+    return sum(_pending.values())
+
+
+async def flush():
+    global _pending, _oldest, _ratings
+    if not _pending and not _ratings:
+        return
+    batch, ratings, started = _pending, _ratings, _oldest
+    _pending, _ratings, _oldest = defaultdict(int), [], None
+
+    plays = defaultdict(int)
+    for (playlist_id, _), count in batch.items():
+        plays[playlist_id] += count
+    events = [{'playlist_id': playlist_id, 'week': week, 'kind': LISTEN, 'value': count}
+              for (playlist_id, week), count in batch.items()]
+    events += [{'playlist_id': playlist_id, 'week': week, 'kind': kind, 'value': value}
+               for playlist_id, week, kind, value in ratings]
+
+    start = time.perf_counter()
+    try:
+        async with session() as db:
+            if plays:
+                await db.execute(_add_plays, [{'playlist_id': playlist_id, 'count': count}
+                                              for playlist_id, count in plays.items()])
+            await db.execute(insert(PlaylistEvent), events)
+            await db.commit()
+    except BaseException as e:
+        # Put everything back so the next flush retries it, also when a shutdown cancelled this one
+        for key, count in batch.items():
+            _pending[key] += count
+        _ratings[:0] = ratings
+        if started is not None:
+            _oldest = min(started, _oldest) if _oldest is not None else started
+        if isinstance(e, Exception):
+            flush_stats['failed_flushes'] += 1
+        raise
+
+    flush_stats['flushes'] += 1
+    flush_stats['plays_flushed'] += sum(batch.values())
+    flush_stats['last_flush_seconds'] = round(time.perf_counter() - start, 4)
+
+
+async def flush_loop():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        # Shielded, so cancelling the loop at shutdown lets a write already in flight finish
+        # instead of leaving it unclear whether the batch was committed
+        flushing = asyncio.ensure_future(flush())
+        try:
+            await asyncio.shield(flushing)
+        except asyncio.CancelledError:
+            try:
+                await flushing
+            except Exception:
+                logging.exception("Failed to flush buffered listens")
+            raise
+        except Exception:
+            logging.exception("Failed to flush buffered listens")
+
+
+async def drain():
+    try:
+        await flush()
+    except Exception:
+        logging.exception("Failed to write buffered listens on shutdown")
+
+
+def _report() -> dict:
+    return {
+        **flush_stats,
+        'pending_plays': pending(),
+        'pending_playlists': len(_pending),
+        'pending_ratings': len(_ratings),
+        # Age of the oldest listen not yet visible in the playlist table
+        'flush_lag_seconds': round(time.monotonic() - _oldest, 3) if _oldest is not None else 0.0,
+    }
+
+
+metrics.register('listen_buffer', _report)
@@ -0,0 +1,52 @@
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Callable
+
+# Upstream (Spotify, Postmark) calls made while serving the current request
+_upstream: ContextVar[list | None] = ContextVar('upstream_calls', default=None)
+
+endpoint_requests = defaultdict(int)
+endpoint_upstream_calls = defaultdict(int)
+
+_sections: dict[str, Callable[[], dict]] = {}
+
+
+def register(name: str, collect: Callable[[], dict]):
+    _sections[name] = collect
+
+
+def begin_request() -> list:
+    calls = [0]
+    _upstream.set(calls)
+    return calls
+
+
+def end_request(endpoint: str, calls: list):
+    endpoint_requests[endpoint] += 1
+    endpoint_upstream_calls[endpoint] += calls[0]
+
+
+def count_upstream():
+    calls = _upstream.get()
+    if calls is None:
+        endpoint_upstream_calls['background'] += 1
+    else:
+        calls[0] += 1
+
+
+def _endpoints():
+    return {
+        endpoint: {
+            'requests': count,
+            'upstream_calls': endpoint_upstream_calls[endpoint],
+            'upstream_calls_per_request': round(endpoint_upstream_calls[endpoint] / count, 3),
+        }
+        for endpoint, count in sorted(endpoint_requests.items())
+    }
+
+
+def snapshot() -> dict:
+    data = {'endpoints': _endpoints(), 'background_upstream_calls': endpoint_upstream_calls['background']}
+    for name, collect in _sections.items():
+        data[name] = collect()
+    return data
@@ -0,0 +1,136 @@
+import logging
+from typing import Callable
+
+if __name__ == '__main__':
+    # Runs before uvicorn; settings read at import below come from .env too
+    from dotenv import load_dotenv
+    load_dotenv()
+
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, select, insert, inspect, text, func  # noqa: E402
+from sqlalchemy.exc import OperationalError, ProgrammingError  # noqa: E402
+from .database import get_engine  # noqa: E402
+from .model import data, EmailOutbox, Job, Following  # noqa: E402
+from . import counters  # noqa: E402
+
+schema_version = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', String, nullable=False),
+    Column('applied_at', DateTime, nullable=False, server_default=func.now()),
+)
+
+MIGRATIONS: list[tuple[int, str, Callable]] = []
+
+
+def migration(version: int, description: str):
+    def register(step):
+        MIGRATIONS.append((version, description, step))
+        return step
+    return register
+
+
+@migration(1, 'create missing tables and the pg_trgm extension')
+def _tables(conn):
+    # create_all fires the model's before_create hook, which adds pg_trgm on Postgres
+    data.metadata.create_all(bind=conn)
+
+
+def _add_column(conn, table: str, column: str, ddl: str):
+    if column in {existing['name'] for existing in inspect(conn).get_columns(table)}:
+        return
+    quote = conn.dialect.identifier_preparer.quote
+    conn.execute(text(f'ALTER TABLE {quote(table)} ADD COLUMN {quote(column)} {ddl}'))
+
+
+@migration(2, 'add spotify_id, rating aggregate and score columns')
+def _columns(conn):
+    _add_column(conn, 'user', 'spotify_id', 'VARCHAR')
+    if 'uq_user_spotify_id' not in {index['name'] for index in inspect(conn).get_indexes('user')} and \
+            not any(constraint['column_names'] == ['spotify_id']
+                    for constraint in inspect(conn).get_unique_constraints('user')):
+        conn.execute(text('CREATE UNIQUE INDEX uq_user_spotify_id ON "user" (spotify_id)'))
+    _add_column(conn, 'playlist', 'rating_sum', 'FLOAT NOT NULL DEFAULT 0')
+    _add_column(conn, 'playlist', 'rating_count', 'INTEGER NOT NULL DEFAULT 0')
+    _add_column(conn, 'playlist', 'score', 'FLOAT NOT NULL DEFAULT 0')
+
+
+@migration(3, 'deduplicate follows and create hot-path indexes')
+def _indexes(conn):
+    conn.execute(text('DELETE FROM follows WHERE id NOT IN '
+                      '(SELECT MIN(id) FROM follows GROUP BY following, follower)'))
+    # Every index declared on the models, for tables that create_all found already there
+    for table in data.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=conn, checkfirst=True)
+
+
+@migration(4, 'backfill counters, rating aggregates and scores')
+def _backfill(conn):
+    for name, rows in counters.reconcile(conn).items():
+        logging.info(f"Backfilled {rows} rows of {name}")
+
+
+@migration(5, 'create the email outbox')
+def _outbox(conn):
+    EmailOutbox.__table__.create(bind=conn, checkfirst=True)
+
+
+@migration(6, 'create the job table')
+def _jobs(conn):
+    Job.__table__.create(bind=conn, checkfirst=True)
+
+
+@migration(7, 'index follows by follower then following')
+def _follows_reverse(conn):
+    if 'ix_follows_follower' in {index['name'] for index in inspect(conn).get_indexes('follows')}:
+        conn.execute(text('DROP INDEX ix_follows_follower'))
+    for index in Following.__table__.indexes:
+        index.create(bind=conn, checkfirst=True)
+
+
+@migration(8, 'record the week each rating was last set in')
+def _rating_week(conn):
+    _add_column(conn, 'rating', 'week', 'INTEGER')
+
+
+@migration(9, "stop storing the caller's Spotify token on jobs")
+def _job_token(conn):
+    if 'token' in {existing['name'] for existing in inspect(conn).get_columns('job')}:
+        conn.execute(text('ALTER TABLE job DROP COLUMN token'))
+
+
+def upgrade(bind=None) -> int:
+    bind = bind or get_engine()
+    applied = 0
+    with bind.begin() as conn:
+        schema_version.create(bind=conn, checkfirst=True)
+    for version, description, step in sorted(MIGRATIONS):
+        with bind.begin() as conn:
+            if conn.dialect.name == 'postgresql':
+                # Several containers can start at once; the first one migrates, the rest wait and skip
+                conn.execute(text('SELECT pg_advisory_xact_lock(7140021)'))
+            if conn.scalar(select(schema_version.c.version).where(schema_version.c.version == version)):
+                continue
+            logging.info(f"Applying migration {version}: {description}")
+            step(conn)
+            conn.execute(insert(schema_version).values(version=version, description=description))
+            applied += 1
+    return applied
+
+
+async def check(db):
+    # One query when a worker starts: migrating is the deploy step's job, a schema behind the code stops here
+    # instead of failing on the first request that touches a new column
+    latest = max(version for version, _, _ in MIGRATIONS)
+    try:
+        current = await db.scalar(select(func.max(schema_version.c.version))) or 0
+    except (OperationalError, ProgrammingError) as e:
+        raise RuntimeError("Database has no schema_version table, run python -m app.schemas.migrations") from e
+    if current < latest:
+        raise RuntimeError(f"Database schema is at version {current}, this code needs {latest}: "
+                           "run python -m app.schemas.migrations")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    logging.info(f"Schema up to date, {upgrade()} migrations applied")
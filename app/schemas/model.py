@@ -1,5 +1,6 @@
 from .database import data
-from sqlalchemy import Column, String, Integer, ForeignKey, Float, DateTime, UniqueConstraint, Table
+from sqlalchemy import Column, String, Text, Integer, BigInteger, SmallInteger, ForeignKey, Float, DateTime, \
+    UniqueConstraint, Table, Index, DDL, event
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 
@@ -28,6 +29,7 @@ class UserModel(data):
     id = Column(Integer, index=True, primary_key=True)
     username = Column(String, nullable=False, unique=True)
     email = Column(String, nullable=False, unique=True)
+    spotify_id = Column(String, nullable=True, unique=True)
     created_playlist = Column(Integer, nullable=False, default=0)
     followers = Column(Integer, nullable=False, default=0)
     following = Column(Integer, nullable=False, default=0)
@@ -44,14 +46,19 @@ class Playlist(data):
 
     id = Column(String, primary_key=True)
     name = Column(String(50), nullable=False, unique=False)
-    user_id = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), nullable=False, index=True)
     genre = Column(String, index=True, nullable=True)
     time = Column(Integer, nullable=True, default=0)
     likes = Column(Integer, nullable=False, default=0)
     dislike = Column(Integer, nullable=False, default=0)
     plays = Column(Integer, nullable=False, default=0)
     rating = Column(Float, nullable=True, default=0.0)
+    # Running aggregate of the rating table, rating is rating_sum / rating_count
+    rating_sum = Column(Float, nullable=False, default=0.0)
+    rating_count = Column(Integer, nullable=False, default=0)
     comments = Column(Integer, nullable=False, default=0)
+    # Leaderboard score, 0.85 * rating + 0.15 * plays, kept current by every rating and plays update
+    score = Column(Float, nullable=False, default=0.0)
 
     users = relationship('UserModel', secondary=playlist_users, back_populates='playlists')
 
@@ -59,6 +66,17 @@ class Playlist(data):
     disliked_by = relationship('UserModel', secondary=playlist_dislikes, back_populates='disliked_playlists')
 
 
+# Serves the /most_vote leaderboard pages in (score desc, id) order
+playlist_score = Index('ix_playlist_score', Playlist.score.desc(), Playlist.id)
+
+# Trigram index behind the similarity() / ilike playlist search, needs the pg_trgm extension
+playlist_name_trgm = Index('ix_playlist_name_trgm', Playlist.name,
+                           postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+
+event.listen(data.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
+
 class Discussion(data):
     __tablename__ = "comments"
 
@@ -69,6 +87,10 @@ class Discussion(data):
     comment = Column(String(100), nullable=False)
 
 
+# Discussion pages walk one playlist's comments in (time_stamp, id) order
+discussion_page = Index('ix_comments_playlist_time', Discussion.playlist_id, Discussion.time_stamp, Discussion.id)
+
+
 class Rating(data):
     __tablename__ = "rating"
 
@@ -76,8 +98,11 @@ class Rating(data):
     user_id = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     playlist_id = Column(String, ForeignKey("playlist.id", ondelete="CASCADE"), nullable=False)
     rating = Column(Float, nullable=False)
+    # ISO week (yyyyww) the rating was last set in; a user's rating counts once per week in the rollup
+    week = Column(Integer, nullable=True)
 
-    __table_args__ = (UniqueConstraint('user_id', 'playlist_id', name='unique_user_playlist'),)
+    __table_args__ = (UniqueConstraint('user_id', 'playlist_id', name='unique_user_playlist'),
+                      Index('ix_rating_playlist', 'playlist_id'))
 
 
 class Following(data):
@@ -87,6 +112,94 @@ class Following(data):
     following = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     follower = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
 
+    # Each direction has an index sorted by the other side: who a user follows and who follows them,
+    # both paged in id order
+    __table_args__ = (Index('uq_follows_pair', 'following', 'follower', unique=True),
+                      Index('ix_follows_reverse', 'follower', 'following'))
+
+
+class Track(data):
+    __tablename__ = 'track'
+
+    id = Column(String(22), primary_key=True)
+    name = Column(String, nullable=False)
+    artist = Column(String, nullable=True)
+    album = Column(String, nullable=True)
+    duration_ms = Column(Integer, nullable=False)
+
+
+class PlaylistEvent(data):
+    # Append-only listen/rating log; listens arrive pre-aggregated per flush, value is the count
+    __tablename__ = 'playlist_event'
+
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    playlist_id = Column(String, nullable=False)
+    week = Column(Integer, nullable=False)
+    kind = Column(SmallInteger, nullable=False)
+    value = Column(Float, nullable=False)
+
+
+class PlaylistWeek(data):
+    __tablename__ = 'playlist_week'
+
+    week = Column(Integer, primary_key=True)
+    playlist_id = Column(String, primary_key=True)
+    plays = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(Float, nullable=False, default=0.0)
+    rating_count = Column(Integer, nullable=False, default=0)
+    score = Column(Float, nullable=False, default=0.0)
+
+
+playlist_week_score = Index('ix_playlist_week_score', PlaylistWeek.week, PlaylistWeek.score.desc(),
+                            PlaylistWeek.playlist_id)
+
+
+class RollupState(data):
+    # Event id watermarks of an incremental rollup job
+    __tablename__ = 'rollup_state'
+
+    name = Column(String, primary_key=True)
+    done_id = Column(BigInteger, nullable=False, default=0)
+    seen_id = Column(BigInteger, nullable=False, default=0)
+
+
+class EmailOutbox(data):
+    # Emails committed together with the change that triggered them, sent later by the outbox worker
+    __tablename__ = 'email_outbox'
+
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    to = Column(String, nullable=False)
+    subject = Column(String, nullable=False)
+    html_body = Column(Text, nullable=False)
+    text_body = Column(Text, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    # Also the claim: a worker pushes it forward while a batch is in flight
+    next_attempt_at = Column(DateTime, nullable=False, default=func.now())
+    sent_at = Column(DateTime, nullable=True)
+    last_error = Column(String, nullable=True)
+
+    __table_args__ = (Index('ix_email_outbox_due', 'sent_at', 'next_attempt_at'),)
+
+
+class Job(data):
+    # A playlist operation submitted with ?mode=async, run by the worker pool in app/schemas/jobs.py
+    __tablename__ = 'job'
+
+    id = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), nullable=False, index=True)
+    kind = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='queued')
+    payload = Column(Text, nullable=False)
+    progress = Column(Text, nullable=True)
+    result = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    lease_until = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=func.now())
+    updated_at = Column(DateTime, nullable=False, default=func.now())
+
+    __table_args__ = (Index('ix_job_status', 'status', 'created_at'),)
+
 
 class State(data):
     __tablename__ = 'state'
@@ -0,0 +1,168 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from datetime import datetime, timedelta
+import httpx
+from sqlalchemy import select, update
+from .database import session
+from .model import EmailOutbox
+from . import metrics
+
+API_URL = os.getenv('POSTMARK_API_URL', 'https://api.postmarkapp.com')
+SENDER = os.getenv('FROM')
+# Postmark accepts at most 500 messages per batch call
+BATCH_SIZE = min(int(os.getenv('OUTBOX_BATCH_SIZE', 500)), 500)
+INTERVAL = float(os.getenv('OUTBOX_INTERVAL', 5))
+MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8))
+BACKOFF_BASE = float(os.getenv('OUTBOX_BACKOFF_BASE', 30))
+BACKOFF_MAX = float(os.getenv('OUTBOX_BACKOFF_MAX', 3600))
+# How long a claimed batch stays invisible to other workers; a worker that dies mid-send is retried after it
+LEASE = timedelta(seconds=int(os.getenv('OUTBOX_LEASE', 120)))
+# Invalid address and inactive recipient: retrying won't help
+PERMANENT_ERRORS = {300, 406}
+
+_client: httpx.AsyncClient | None = None
+_wake: asyncio.Event | None = None
+
+outbox_stats = {'batches': 0, 'sent': 0, 'retried': 0, 'abandoned': 0, 'failed_batches': 0,
+                'last_batch_seconds': 0.0}
+metrics.register('email_outbox', lambda: outbox_stats)
+
+
+def welcome(db, user_email, user_firstname):
+    # Added to the caller's session, so the email exists exactly when the user row commits
+    db.add(EmailOutbox(
+        to=user_email,
+        subject='Welcome To Dashie',
+        html_body=f'''
+    <div style="font-family: Arial, sans-serif; color: #333; background-color: #f0f4f8; padding: 20px; border-radius: 10px; text-align: center;">
+        <h3 style="color: #4caf50;">🎉 Hey, {user_firstname}! 🎉</h3>
+        <p style="font-size: 15px;">
+            We are pleased to have you onboard, Welcome to a great experience Buckle up cause listening to music has not been this fun.
+        </p>
+        <p style="font-size: 15px; margin-top: 10px;">
+            We are streaming platform that allow for listeners like you to not only play music but also be able to share your experience with your friends by collaborating to create playlist together and so much more
+        </p>
+        <div style="margin-top: 15px;">
+            <a href="https://spotify-dv92.onrender.com/user/login" style="text-decoration: none; background-color: #4caf50; color: green; padding: 10px 20px; border-radius: 5px; font-size: 15px;">Begin your journey</a>
+        </div>
+        <p style="font-size: 14px; color: #757575; margin-top: 20px;">
+            Once again Welcome,<br/>
+            <strong>Dashie</strong>
+        </p>
+    </div>
+''',
+        text_body=f'Hey {user_firstname},\n We are pleased to have you onboard, Welcome to a great experience Buckle up cause listening to music has not been this fun.\n We are streaming platform that allow for listeners like you to not only play music but also'
+                f'be able to share your experience with your friends by collaborating to create playlist together and so much more.\n\n\n Once again Welcome to Dashie \n You can begin your journey here https://spotify-dv92.onrender.com/user/login',
+    ))
+
+
+def notify():
+    # Wakes the worker now instead of at its next interval
+    if _wake is not None:
+        _wake.set()
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(timeout=httpx.Timeout(float(os.getenv('POSTMARK_TIMEOUT', 10))))
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX) * random.uniform(0.5, 1))
+
+
+async def _claim(db) -> list[EmailOutbox]:
+    now = datetime.utcnow()
+    emails = list(await db.scalars(
+        select(EmailOutbox).
+        where(EmailOutbox.sent_at.is_(None), EmailOutbox.attempts < MAX_ATTEMPTS, EmailOutbox.next_attempt_at <= now).
+        order_by(EmailOutbox.id).limit(BATCH_SIZE).with_for_update(skip_locked=True)
+    ))
+    if emails:
+        await db.execute(update(EmailOutbox).where(EmailOutbox.id.in_([email.id for email in emails])).
+                         values(next_attempt_at=now + LEASE))
+    await db.commit()
+    return emails
+
+
+async def _post(emails: list[EmailOutbox]) -> list[dict]:
+    metrics.count_upstream()
+    response = await get_client().post(
+        f'{API_URL}/email/batch',
+        headers={'Accept': 'application/json', 'X-Postmark-Server-Token': os.getenv('POSTMARK', '')},
+        json=[{'From': SENDER, 'To': email.to, 'Subject': email.subject, 'HtmlBody': email.html_body,
+               'TextBody': email.text_body, 'MessageStream': 'outbound'} for email in emails],
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+async def send_batch() -> int:
+    start = time.perf_counter()
+    async with session() as db:
+        emails = await _claim(db)
+        if not emails:
+            return 0
+
+        try:
+            results = await _post(emails)
+        except (httpx.HTTPError, ValueError) as e:
+            # The whole call failed, nothing in it was sent
+            logging.error(f"Postmark batch of {len(emails)} emails failed: {e!r}")
+            outbox_stats['failed_batches'] += 1
+            results = [{'ErrorCode': -1, 'Message': repr(e)}] * len(emails)
+
+        now = datetime.utcnow()
+        sent, failed = [], []
+        # Postmark answers a batch with one result per message, in order
+        for email, result in zip(emails, results):
+            if result.get('ErrorCode') == 0:
+                sent.append(email.id)
+                continue
+            attempts = MAX_ATTEMPTS if result.get('ErrorCode') in PERMANENT_ERRORS else email.attempts + 1
+            failed.append({'id': email.id, 'attempts': attempts, 'next_attempt_at': now + backoff(attempts),
+                           'last_error': str(result.get('Message'))[:500]})
+            outbox_stats['abandoned' if attempts >= MAX_ATTEMPTS else 'retried'] += 1
+
+        if sent:
+            await db.execute(update(EmailOutbox).where(EmailOutbox.id.in_(sent)).values(sent_at=now))
+        if failed:
+            await db.execute(update(EmailOutbox), failed)
+        await db.commit()
+
+    outbox_stats['batches'] += 1
+    outbox_stats['sent'] += len(sent)
+    outbox_stats['last_batch_seconds'] = round(time.perf_counter() - start, 6)
+    return len(emails)
+
+
+async def drain():
+    while await send_batch() == BATCH_SIZE:
+        pass
+
+
+async def outbox_loop():
+    global _wake
+    _wake = asyncio.Event()
+    while True:
+        try:
+            await asyncio.wait_for(_wake.wait(), INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wake.clear()
+        try:
+            await drain()
+        except Exception:
+            logging.exception("Failed to send queued emails")
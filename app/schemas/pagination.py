@@ -0,0 +1,18 @@
+import base64
+import json
+from fastapi import HTTPException
+from starlette import status
+
+
+def encode_cursor(*values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def decode_cursor(cursor: str, size: int | None = None) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+    if not isinstance(values, list) or (size is not None and len(values) != size):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+    return values
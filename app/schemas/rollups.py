@@ -0,0 +1,107 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+
+from sqlalchemy import select, case, func, desc  # noqa: E402
+from .database import dialect_insert, session  # noqa: E402
+from .model import Playlist, PlaylistEvent, PlaylistWeek, RollupState  # noqa: E402
+from .counters import RATING_WEIGHT, PLAYS_WEIGHT  # noqa: E402
+
+LISTEN = 1
+# A rating new to its week: adds the value and one to the count
+RATING = 2
+# A rating changed within the week it was counted in: moves the sum by the difference only
+RATING_CHANGE = 3
+
+ROLLUP_INTERVAL = int(os.getenv('ROLLUP_INTERVAL', 300))
+
+
+def week_of(moment: datetime | None = None) -> int:
+    # ISO week as yyyyww, e.g. 202642
+    year, week, _ = (moment or datetime.now(timezone.utc)).isocalendar()
+    return year * 100 + week
+
+
+def _weekly_score(rating_sum, rating_count, plays):
+    rating = case((rating_count > 0, rating_sum / rating_count), else_=0.0)
+    return rating * RATING_WEIGHT + plays * PLAYS_WEIGHT
+
+
+def _upsert():
+    week = PlaylistWeek.__table__
+    statement = dialect_insert(week)
+    plays = week.c.plays + statement.excluded.plays
+    rating_sum = week.c.rating_sum + statement.excluded.rating_sum
+    rating_count = week.c.rating_count + statement.excluded.rating_count
+    return statement.on_conflict_do_update(
+        index_elements=[week.c.week, week.c.playlist_id],
+        set_={'plays': plays, 'rating_sum': rating_sum, 'rating_count': rating_count,
+              'score': _weekly_score(rating_sum, rating_count, plays)},
+    )
+
+
+async def rollup(db) -> int:
+    # Only events up to the max id seen on the previous run are folded in, so a flush whose
+    # ids were allocated but not yet committed back then can't be skipped by the watermark
+    state = await db.scalar(select(RollupState).where(RollupState.name == 'playlist_week').with_for_update())
+    if state is None:
+        state = RollupState(name='playlist_week', done_id=0, seen_id=0)
+        db.add(state)
+
+    rows = []
+    if state.seen_id > state.done_id:
+        rows = (await db.execute(
+            select(PlaylistEvent.week, PlaylistEvent.playlist_id,
+                   func.sum(case((PlaylistEvent.kind == LISTEN, PlaylistEvent.value), else_=0)),
+                   func.sum(case((PlaylistEvent.kind.in_((RATING, RATING_CHANGE)), PlaylistEvent.value), else_=0)),
+                   func.sum(case((PlaylistEvent.kind == RATING, 1), else_=0))).
+            where(PlaylistEvent.id > state.done_id).where(PlaylistEvent.id <= state.seen_id).
+            group_by(PlaylistEvent.week, PlaylistEvent.playlist_id)
+        )).all()
+    if rows:
+        await db.execute(_upsert(), [
+            {'week': week, 'playlist_id': playlist_id, 'plays': int(plays), 'rating_sum': rating_sum,
+             'rating_count': count,
+             'score': (rating_sum / count if count else 0.0) * RATING_WEIGHT + plays * PLAYS_WEIGHT}
+            for week, playlist_id, plays, rating_sum, count in rows
+        ])
+
+    state.done_id = state.seen_id
+    state.seen_id = await db.scalar(select(func.coalesce(func.max(PlaylistEvent.id), 0)))
+    await db.commit()
+    return len(rows)
+
+
+async def rollup_loop():
+    while True:
+        await asyncio.sleep(ROLLUP_INTERVAL)
+        try:
+            async with session() as db:
+                await rollup(db)
+        except Exception:
+            logging.exception("Failed to roll up playlist events")
+
+
+async def top_week(db, week: int, limit: int):
+    return (await db.execute(
+        select(Playlist, PlaylistWeek).join(Playlist, Playlist.id == PlaylistWeek.playlist_id).
+        where(PlaylistWeek.week == week).order_by(desc(PlaylistWeek.score), PlaylistWeek.playlist_id).limit(limit)
+    )).all()
+
+
+async def _main():
+    async with session() as db:
+        # Twice, so events seen on the first pass are folded in on the second
+        for _ in range(2):
+            rows = await rollup(db)
+            logging.info(f"Rolled up {rows} playlist weeks")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    asyncio.run(_main())
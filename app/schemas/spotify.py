@@ -0,0 +1,132 @@
+import os
+import time
+import asyncio
+import logging
+import httpx
+from cachetools import TLRUCache
+from fastapi import HTTPException
+from starlette import status
+from . import metrics
+
+API_URL = os.getenv('SPOTIFY_API_URL', 'https://api.spotify.com/v1')
+ACCOUNTS_URL = os.getenv('SPOTIFY_ACCOUNTS_URL', 'https://accounts.spotify.com')
+
+_client: httpx.AsyncClient | None = None
+
+# Access token -> monotonic time it stops being trusted, so "is it expired" needs no network call
+TOKEN_EXPIRY_MARGIN = int(os.getenv('SPOTIFY_TOKEN_EXPIRY_MARGIN', 60))
+TOKEN_PROBE_TTL = int(os.getenv('SPOTIFY_TOKEN_PROBE_TTL', 300))
+_tokens = TLRUCache(maxsize=int(os.getenv('SPOTIFY_TOKEN_CACHE_SIZE', 10000)),
+                    ttu=lambda _, expires_at, now: expires_at,
+                    timer=time.monotonic)
+
+# Spotify accepts at most 100 tracks per playlist add/remove call
+CHUNK_SIZE = 100
+CHUNK_CONCURRENCY = int(os.getenv('SPOTIFY_CHUNK_CONCURRENCY', 4))
+
+
+def remember_token(token: str, expires_in: int):
+    _tokens[token] = time.monotonic() + max(int(expires_in) - TOKEN_EXPIRY_MARGIN, 0)
+
+
+def forget_token(token: str):
+    _tokens.pop(token, None)
+
+
+def token_known_valid(token: str) -> bool:
+    return token in _tokens
+
+
+def _http2_enabled():
+    if os.getenv('SPOTIFY_HTTP2', 'false').lower() not in ('1', 'true', 'yes'):
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logging.warning("SPOTIFY_HTTP2 is set but the h2 package is not installed, using HTTP/1.1")
+        return False
+    return True
+
+
+def get_client() -> httpx.AsyncClient:
+    # One pooled client per worker so connections to Spotify are kept alive and reused
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=_http2_enabled(),
+            limits=httpx.Limits(
+                max_connections=int(os.getenv('SPOTIFY_MAX_CONNECTIONS', 100)),
+                max_keepalive_connections=int(os.getenv('SPOTIFY_MAX_KEEPALIVE', 20)),
+                keepalive_expiry=float(os.getenv('SPOTIFY_KEEPALIVE_EXPIRY', 30)),
+            ),
+            timeout=httpx.Timeout(float(os.getenv('SPOTIFY_TIMEOUT', 10))),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _send(method: str, url: str, **kwargs) -> httpx.Response:
+    metrics.count_upstream()
+    try:
+        return await get_client().request(method, url, **kwargs)
+    except httpx.TransportError as e:
+        logging.error(f"Spotify request {method} {url} failed: {e!r}")
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail='Failed to reach spotify, try again')
+
+
+async def api(method: str, path: str, token: str, **kwargs) -> httpx.Response:
+    headers = {'Authorization': f'Bearer {token}', **kwargs.pop('headers', {})}
+    response = await _send(method, f'{API_URL}{path}', headers=headers, **kwargs)
+    if response.status_code == 401:
+        forget_token(token)
+    return response
+
+
+async def accounts(method: str, path: str, **kwargs) -> httpx.Response:
+    return await _send(method, f'{ACCOUNTS_URL}{path}', **kwargs)
+
+
+async def add_playlist_tracks(playlist_id: str, track_ids: list[str], token: str, on_progress=None) -> dict:
+    # Sequential so the tracks keep the order they were sent in
+    done, snapshot_id = [], None
+    for start in range(0, len(track_ids), CHUNK_SIZE):
+        chunk = track_ids[start:start + CHUNK_SIZE]
+        response = await api('POST', f'/playlists/{playlist_id}/tracks', token,
+                             json={'uris': [f'spotify:track:{track}' for track in chunk]})
+        if response.status_code != 201:
+            return {'done': done, 'snapshot_id': snapshot_id, 'error': response}
+        snapshot_id = response.json().get('snapshot_id', snapshot_id)
+        done.extend(chunk)
+        if on_progress:
+            await on_progress(len(done))
+    return {'done': done, 'snapshot_id': snapshot_id, 'error': None}
+
+
+async def remove_playlist_tracks(playlist_id: str, track_ids: list[str], token: str, on_progress=None) -> dict:
+    # Removal is by uri, so chunks don't depend on each other and can run side by side
+    semaphore = asyncio.Semaphore(CHUNK_CONCURRENCY)
+    result = {'done': [], 'snapshot_id': None, 'error': None}
+
+    async def send(chunk):
+        async with semaphore:
+            if result['error'] is not None:
+                return
+            response = await api('DELETE', f'/playlists/{playlist_id}/tracks', token,
+                                 json={'tracks': [{'uri': f'spotify:track:{track}'} for track in chunk]})
+        if response.status_code != 200:
+            result['error'] = response
+            return
+        result['snapshot_id'] = response.json().get('snapshot_id', result['snapshot_id'])
+        result['done'].extend(chunk)
+        if on_progress:
+            await on_progress(len(result['done']))
+
+    await asyncio.gather(*(send(track_ids[start:start + CHUNK_SIZE])
+                           for start in range(0, len(track_ids), CHUNK_SIZE)))
+    return result
@@ -0,0 +1,135 @@
+import os
+import re
+import sys
+import asyncio
+from cachetools import LRUCache
+from fastapi import HTTPException
+from sqlalchemy import update, case, func, select
+from .database import insert_or_ignore
+from .model import Playlist, Track
+from . import spotify
+
+
+class TrackRecord:
+    __slots__ = ('id', 'name', 'artist', 'album', 'duration_ms')
+
+    def __init__(self, id: str, name: str, artist: str | None, album: str | None, duration_ms: int):
+        self.id = id
+        self.name = name
+        # Artists and albums repeat across tracks, share one string per value
+        self.artist = sys.intern(artist) if artist else None
+        self.album = sys.intern(album) if album else None
+        self.duration_ms = duration_ms
+
+    @classmethod
+    def from_spotify(cls, track: dict):
+        artists = track.get('artists') or [{}]
+        return cls(track['id'], track.get('name') or '', artists[0].get('name'),
+                   (track.get('album') or {}).get('name'), track.get('duration_ms') or 0)
+
+    def row(self) -> dict:
+        return {'id': self.id, 'name': self.name, 'artist': self.artist, 'album': self.album,
+                'duration_ms': self.duration_ms}
+
+
+TRACK_ID = re.compile(r'[0-9A-Za-z]{22}')
+
+
+def clean_ids(track_ids) -> tuple[list[str], int]:
+    # Valid Spotify ids in first-seen order, plus how many entries were dropped
+    valid = list(dict.fromkeys(track for track in track_ids if TRACK_ID.fullmatch(track)))
+    return valid, len(track_ids) - len(valid)
+
+
+store = LRUCache(maxsize=int(os.getenv('TRACK_CACHE_SIZE', 100000)))
+# Records seen in Spotify payloads but not yet written to the track table
+_unsaved: dict[str, TrackRecord] = {}
+
+
+def get(track_id: str) -> TrackRecord | None:
+    return store.get(track_id)
+
+
+def remember(items):
+    for track in items:
+        if not track or not track.get('id') or track.get('duration_ms') is None:
+            continue
+        if track['id'] not in store:
+            record = TrackRecord.from_spotify(track)
+            store[record.id] = record
+            _unsaved[record.id] = record
+
+
+async def save_pending(db):
+    if not _unsaved:
+        return
+    rows = [record.row() for record in _unsaved.values()]
+    _unsaved.clear()
+    await db.execute(insert_or_ignore(Track), rows)
+    await db.commit()
+
+
+async def resolve(track_ids, token: str, db) -> dict[str, TrackRecord]:
+    found = {}
+    missing = []
+    for track_id in dict.fromkeys(track_ids):
+        record = store.get(track_id)
+        if record is not None:
+            found[track_id] = record
+        else:
+            missing.append(track_id)
+
+    if missing:
+        for row in await db.scalars(select(Track).where(Track.id.in_(missing))):
+            record = store[row.id] = TrackRecord(row.id, row.name, row.artist, row.album, row.duration_ms)
+            found[row.id] = record
+        missing = [track_id for track_id in missing if track_id not in found]
+
+    # /v1/tracks takes at most 50 ids per call
+    semaphore = asyncio.Semaphore(spotify.CHUNK_CONCURRENCY)
+
+    async def fetch(batch):
+        async with semaphore:
+            response = await spotify.api('GET', '/tracks', token, params={'ids': ','.join(batch)})
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail=response.json())
+        remember(response.json()['tracks'])
+        found.update((track_id, store[track_id]) for track_id in batch if track_id in store)
+
+    await asyncio.gather(*(fetch(missing[start:start + 50]) for start in range(0, len(missing), 50)))
+
+    await save_pending(db)
+    return found
+
+
+async def resolve_durations(track_ids, token: str, db) -> dict[str, int]:
+    return {track_id: record.duration_ms for track_id, record in (await resolve(track_ids, token, db)).items()}
+
+
+async def playlist_items(playlist_id: str, token: str) -> list[dict]:
+    # Every track over every page of the playlist, once per copy
+    found = []
+    offset = 0
+    while True:
+        page = await spotify.api('GET', f'/playlists/{playlist_id}/tracks', token,
+                                 params={'offset': offset, 'limit': 100,
+                                         'fields': 'total,next,items(track(id,name,duration_ms,artists(name),album(name)))'})
+        if page.status_code != 200:
+            raise HTTPException(status_code=page.status_code, detail=page.json())
+        data = page.json()
+        items = [item.get('track') for item in data['items']]
+        remember(items)
+        found += [track for track in items if track]
+        offset += 100
+        if not data.get('next') or offset >= data.get('total', 0):
+            return found
+
+
+async def playlist_duration(playlist_id: str, token: str) -> int:
+    # Full recount, in seconds
+    return sum(track.get('duration_ms') or 0 for track in await playlist_items(playlist_id, token)) // 1000
+
+
+def adjust_time(playlist_id: str, delta_ms: int):
+    time = func.coalesce(Playlist.time, 0) + round(delta_ms / 1000)
+    return update(Playlist).where(Playlist.id == playlist_id).values(time=case((time < 0, 0), else_=time))
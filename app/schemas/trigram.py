@@ -0,0 +1,125 @@
+import os
+import re
+import asyncio
+import logging
+from array import array
+from collections import Counter
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from .database import DATABASE_URL, session
+from .model import Playlist
+from . import metrics
+
+SEARCH_MODE = os.getenv('PLAYLIST_SEARCH', 'auto')
+REFRESH_INTERVAL = int(os.getenv('PLAYLIST_INDEX_REFRESH', 300))
+# Lowest similarity a name may have to match, here and in pg_trgm's % operator
+SIMILARITY_THRESHOLD = 0.2
+_WORD = re.compile(r'[^\W_]+')
+
+
+def trigrams(text: str) -> set[str]:
+    # Same padding rules as pg_trgm so scores line up with similarity()
+    grams = set()
+    for word in _WORD.findall(text.lower()):
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex:
+    def __init__(self):
+        self._ids: list[str | None] = []
+        self._names: list[str | None] = []
+        self._sizes = array('H')
+        self._docs: dict[str, int] = {}
+        self._postings: dict[str, array] = {}
+        self._removed = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, playlist_id: str, name: str):
+        if playlist_id in self._docs:
+            self.remove(playlist_id)
+        doc = len(self._ids)
+        grams = trigrams(name)
+        self._ids.append(playlist_id)
+        self._names.append(name.lower())
+        self._sizes.append(len(grams))
+        self._docs[playlist_id] = doc
+        for gram in grams:
+            postings = self._postings.get(gram)
+            if postings is None:
+                postings = self._postings[gram] = array('I')
+            postings.append(doc)
+
+    def remove(self, playlist_id: str):
+        doc = self._docs.pop(playlist_id, None)
+        if doc is None:
+            return
+        self._ids[doc] = None
+        self._names[doc] = None
+        self._removed += 1
+        if self._removed > 1000 and self._removed * 2 > len(self._ids):
+            self._compact()
+
+    def _compact(self):
+        live = [(playlist_id, name) for playlist_id, name in zip(self._ids, self._names) if playlist_id is not None]
+        self.__init__()
+        for playlist_id, name in live:
+            self.add(playlist_id, name)
+
+    def search(self, query: str, threshold: float = SIMILARITY_THRESHOLD) -> list[tuple[float, str]]:
+        grams = trigrams(query)
+        if not grams:
+            return []
+        shared = Counter()
+        for gram in grams:
+            postings = self._postings.get(gram)
+            if postings is not None:
+                shared.update(postings)
+
+        needle = query.lower()
+        results = []
+        for doc, count in shared.items():
+            playlist_id = self._ids[doc]
+            if playlist_id is None:
+                continue
+            score = count / (len(grams) + self._sizes[doc] - count)
+            if score > threshold or needle in self._names[doc]:
+                results.append((score, playlist_id))
+        results.sort(key=lambda item: (-item[0], item[1]))
+        return results
+
+    def stats(self) -> dict:
+        return {'playlists': len(self._docs), 'trigrams': len(self._postings), 'tombstones': self._removed}
+
+
+playlist_index = TrigramIndex()
+metrics.register('playlist_index', playlist_index.stats)
+
+
+def use_index() -> bool:
+    # auto: Postgres answers with pg_trgm, anything else (SQLite in tests) uses the in-process index
+    if SEARCH_MODE == 'auto':
+        return make_url(DATABASE_URL).get_backend_name() != 'postgresql'
+    return SEARCH_MODE == 'memory'
+
+
+async def load_playlists(db):
+    index = TrigramIndex()
+    for playlist_id, name in await db.execute(select(Playlist.id, Playlist.name)):
+        index.add(playlist_id, name)
+    # Swap the whole structure so searches never see a half-built index
+    playlist_index.__dict__.update(index.__dict__)
+
+
+async def refresh_loop():
+    # Other workers create and delete playlists too, so rebuild from the table now and then
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL)
+        try:
+            async with session() as db:
+                await load_playlists(db)
+        except Exception:
+            logging.exception("Failed to refresh the playlist search index")
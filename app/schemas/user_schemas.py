@@ -1,8 +1,17 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from typing import Optional, List
 from datetime import datetime
 
 
+class CurrentUser(BaseModel):
+    model_config = ConfigDict(frozen=True, from_attributes=True)
+
+    id: int
+    username: str
+    email: str
+    spotify_id: Optional[str] = None
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -37,6 +46,22 @@ class PlaylistReturn(BaseModel):
     comments: int
 
 
+class FollowUser(BaseModel):
+    id: int
+    username: str
+
+
+class FollowResponse(BaseModel):
+    users: List[FollowUser]
+    next_cursor: Optional[str] = None
+
+
+class Relationship(BaseModel):
+    following: bool
+    follows_you: bool
+    mutual: bool
+
+
 class DiscussionReturn(BaseModel):
     comment: str
     time: datetime
@@ -45,11 +70,13 @@ class DiscussionReturn(BaseModel):
 class DiscussionResponse(BaseModel):
     comments: Optional[List[DiscussionReturn]] = None
     message: Optional[str] = None
+    next_cursor: Optional[str] = None
 
 
 class PlaylistResponse(BaseModel):
     playlists: Optional[List[PlaylistReturn]] = None
     message: Optional[str] = None
+    next_cursor: Optional[str] = None
 
 
 class AddTrack(BaseModel):
@@ -0,0 +1,61 @@
+"""Time to import (and then remove) a large track list against the fake Spotify.
+
+    python -m benchmarks.bulk_tracks --tracks 5000
+
+Adds go out as ordered 100-uri chunks; removals are timed once one chunk at a
+time and once with SPOTIFY_CHUNK_CONCURRENCY chunks in flight. A single
+unchunked call is shown first to confirm the fake rejects it like Spotify.
+"""
+import argparse
+import asyncio
+import os
+import random
+import string
+import time
+
+PORT = int(os.getenv('FAKE_SPOTIFY_PORT', 9000))
+os.environ.setdefault('SPOTIFY_API_URL', f'http://127.0.0.1:{PORT}/v1')
+
+from app.schemas import spotify  # noqa: E402
+from benchmarks.fake_spotify import serve, playlists  # noqa: E402
+
+
+def track_ids(count):
+    return [''.join(random.choices(string.ascii_letters + string.digits, k=22)) for _ in range(count)]
+
+
+async def timed(label, call):
+    start = time.perf_counter()
+    result = await call()
+    print(f'{label:>28}: {time.perf_counter() - start:7.2f} s')
+    return result
+
+
+async def main(count):
+    ids = track_ids(count)
+    response = await spotify.api('POST', '/playlists/single/tracks', 'bench',
+                                 json={'uris': [f'spotify:track:{track}' for track in ids]})
+    print(f'{"single call":>28}: HTTP {response.status_code}')
+
+    result = await timed('chunked add (ordered)', lambda: spotify.add_playlist_tracks('bench', ids, 'bench'))
+    assert playlists['bench']['tracks'] == ids and result['error'] is None
+
+    spotify.CHUNK_CONCURRENCY, concurrency = 1, spotify.CHUNK_CONCURRENCY
+    await timed('chunked remove, 1 in flight', lambda: spotify.remove_playlist_tracks('bench', ids, 'bench'))
+    assert not playlists['bench']['tracks']
+
+    await spotify.add_playlist_tracks('bench', ids, 'bench')
+    spotify.CHUNK_CONCURRENCY = concurrency
+    await timed(f'chunked remove, {concurrency} in flight',
+                lambda: spotify.remove_playlist_tracks('bench', ids, 'bench'))
+    assert not playlists['bench']['tracks']
+    await spotify.close_client()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tracks', type=int, default=5000)
+    args = parser.parse_args()
+    server = serve(PORT)
+    asyncio.run(main(args.tracks))
+    server.should_exit = True
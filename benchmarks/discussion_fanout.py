@@ -0,0 +1,57 @@
+"""Fan-out latency of the discussion broker with N subscribers on one playlist.
+
+    python -m benchmarks.discussion_fanout --subscribers 10000 --messages 200
+
+Every subscriber is a task waiting on its queue, the way each WebSocket
+handler does. Latency is measured from publish() to the moment each task has
+the message; a handful of subscribers never read, to show they get dropped
+once their queue fills instead of holding the others back.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from app.schemas.broker import Broker
+
+
+async def main(subscribers, messages, stalled):
+    broker = Broker('bench_fanout')
+    latencies = []
+    received = [0]
+
+    async def reader(subscription):
+        while (message := await subscription.get()) is not None:
+            latencies.append(time.perf_counter() - message['sent'])
+            received[0] += 1
+
+    readers = [asyncio.create_task(reader(broker.subscribe('bench'))) for _ in range(subscribers)]
+    for _ in range(stalled):
+        broker.subscribe('bench')
+    await asyncio.sleep(0)
+
+    fanout = []
+    for _ in range(messages):
+        start = time.perf_counter()
+        await broker.publish('bench', {'comment': 'hello', 'sent': start})
+        fanout.append(time.perf_counter() - start)
+        await asyncio.sleep(0.001)
+    while received[0] < subscribers * messages:
+        await asyncio.sleep(0.01)
+
+    for task in readers:
+        task.cancel()
+    latencies.sort()
+    print(f'{subscribers} subscribers x {messages} messages')
+    print(f'  publish (enqueue to all)  p50 {statistics.median(fanout) * 1000:7.2f} ms  max {max(fanout) * 1000:7.2f} ms')
+    print(f'  delivery latency          p50 {statistics.median(latencies) * 1000:7.2f} ms  '
+          f'p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.2f} ms  max {latencies[-1] * 1000:7.2f} ms')
+    print(f'  stats {broker.stats()}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subscribers', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--stalled', type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.subscribers, args.messages, args.stalled))
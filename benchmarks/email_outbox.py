@@ -0,0 +1,90 @@
+"""Welcome emails: one blocking Postmark call per login vs the outbox and batch sender.
+
+    DATABASE_URL=sqlite:////tmp/outbox.db python -m benchmarks.email_outbox --emails 2000 --failure-rate 0.2
+
+Runs against benchmarks.fake_postmark (FAKE_POSTMARK_LATENCY, default 200 ms).
+It reports:
+- what a login used to wait for: one POST /email per new user, in the request
+- what a login waits for now: adding the outbox row and committing it
+- how long the worker takes to deliver everything through /email/batch, with
+  the given fraction of calls failing and being retried with backoff
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/outbox.db')
+os.environ.setdefault('POSTMARK', 'bench')
+os.environ.setdefault('FROM', 'bench@example.com')
+os.environ.setdefault('POSTMARK_API_URL', 'http://127.0.0.1:9012')
+# Short backoff so failed batches come due again within the run
+os.environ.setdefault('OUTBOX_BACKOFF_BASE', '0.05')
+
+import httpx  # noqa: E402
+from sqlalchemy import select, func  # noqa: E402
+from app.schemas import outbox  # noqa: E402
+from app.schemas.database import session  # noqa: E402
+from app.schemas.migrations import upgrade  # noqa: E402
+from app.schemas.model import EmailOutbox  # noqa: E402
+from benchmarks import fake_postmark  # noqa: E402
+
+
+async def blocking_sends(count):
+    timings = []
+    async with httpx.AsyncClient() as client:
+        for i in range(count):
+            start = time.perf_counter()
+            await client.post(f'{outbox.API_URL}/email', headers={'X-Postmark-Server-Token': 'bench'},
+                              json={'From': outbox.SENDER, 'To': f'user{i}@example.com', 'Subject': 'Welcome'})
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+async def enqueue(count):
+    timings = []
+    for i in range(count):
+        start = time.perf_counter()
+        async with session() as db:
+            outbox.welcome(db, f'user{i}@example.com', f'User {i}')
+            await db.commit()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+async def deliver():
+    while True:
+        await outbox.drain()
+        async with session() as db:
+            left = await db.scalar(select(func.count()).select_from(EmailOutbox).
+                                   where(EmailOutbox.sent_at.is_(None), EmailOutbox.attempts < outbox.MAX_ATTEMPTS))
+        if not left:
+            return
+        await asyncio.sleep(0.01)
+
+
+async def main(count, blocking):
+    old = await blocking_sends(blocking)
+    new = await enqueue(count)
+    start = time.perf_counter()
+    await deliver()
+    elapsed = time.perf_counter() - start
+    await outbox.close_client()
+
+    print(f'{"blocking send":>16}: p50 {statistics.median(old) * 1000:7.2f} ms per login ({blocking} sends)')
+    print(f'{"outbox insert":>16}: p50 {statistics.median(new) * 1000:7.2f} ms per login ({count} logins)')
+    print(f'{"batch delivery":>16}: {elapsed:7.2f} s for {count} emails, {outbox.outbox_stats}')
+    print(f'{"fake postmark":>16}: {fake_postmark.stats}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--emails', type=int, default=2000)
+    parser.add_argument('--blocking', type=int, default=20, help='sequential single sends to time')
+    parser.add_argument('--failure-rate', type=float, default=0.2)
+    args = parser.parse_args()
+    fake_postmark.FAILURE_RATE = args.failure_rate
+    upgrade()
+    fake_postmark.serve(9012)
+    asyncio.run(main(args.emails, args.blocking))
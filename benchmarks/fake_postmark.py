@@ -0,0 +1,74 @@
+"""A small stand-in for Postmark's email API used by the benchmarks.
+
+Run it on its own with `uvicorn benchmarks.fake_postmark:app --port 9012` and
+point the api at it with POSTMARK_API_URL=http://127.0.0.1:9012.
+FAKE_POSTMARK_LATENCY sets the simulated latency of each call in
+milliseconds. FAKE_POSTMARK_FAILURE_RATE is the fraction of calls answered
+with a 500. Addresses starting with "invalid" are rejected with error code
+300, the way Postmark rejects a malformed recipient.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+import uuid
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+LATENCY = float(os.getenv('FAKE_POSTMARK_LATENCY', 200)) / 1000
+FAILURE_RATE = float(os.getenv('FAKE_POSTMARK_FAILURE_RATE', 0))
+
+stats = {'calls': 0, 'failed_calls': 0, 'delivered': 0, 'rejected': 0}
+
+
+def _result(message: dict) -> dict:
+    if message.get('To', '').startswith('invalid'):
+        stats['rejected'] += 1
+        return {'ErrorCode': 300, 'Message': 'Invalid email request', 'To': message.get('To')}
+    stats['delivered'] += 1
+    return {'ErrorCode': 0, 'Message': 'OK', 'To': message.get('To'), 'MessageID': str(uuid.uuid4())}
+
+
+async def _call(request: Request):
+    stats['calls'] += 1
+    if LATENCY:
+        await asyncio.sleep(LATENCY)
+    if request.headers.get('X-Postmark-Server-Token') is None:
+        return JSONResponse({'ErrorCode': 10, 'Message': 'No Account or Server API tokens were supplied'},
+                            status_code=401)
+    if random.random() < FAILURE_RATE:
+        stats['failed_calls'] += 1
+        return JSONResponse({'ErrorCode': 500, 'Message': 'Internal server error'}, status_code=500)
+    return await request.json()
+
+
+async def email(request: Request):
+    body = await _call(request)
+    return body if isinstance(body, JSONResponse) else JSONResponse(_result(body))
+
+
+async def batch(request: Request):
+    body = await _call(request)
+    if isinstance(body, JSONResponse):
+        return body
+    if len(body) > 500:
+        return JSONResponse({'ErrorCode': 300, 'Message': 'Batch is limited to 500 messages'}, status_code=422)
+    return JSONResponse([_result(message) for message in body])
+
+
+app = Starlette(routes=[
+    Route('/email', email, methods=['POST']),
+    Route('/email/batch', batch, methods=['POST']),
+])
+
+
+def serve(port: int = 9012) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
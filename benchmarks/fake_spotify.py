@@ -0,0 +1,151 @@
+"""A small in-memory stand-in for the Spotify Web API used by the benchmarks.
+
+Run it on its own with `uvicorn benchmarks.fake_spotify:app --port 9000` and point
+the api at it with SPOTIFY_API_URL=http://127.0.0.1:9000/v1 and
+SPOTIFY_ACCOUNTS_URL=http://127.0.0.1:9000. FAKE_SPOTIFY_LATENCY sets the
+simulated upstream latency in milliseconds.
+"""
+import asyncio
+import os
+import random
+import string
+import threading
+import time
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+LATENCY = float(os.getenv('FAKE_SPOTIFY_LATENCY', 50)) / 1000
+
+playlists: dict[str, dict] = {}
+
+
+def _id():
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=22))
+
+
+def _track(track_id):
+    return {
+        'id': track_id,
+        'name': f'Track {track_id[:6]}',
+        'duration_ms': 120000 + sum(map(ord, track_id)) % 120000,
+        'artists': [{'name': 'Fake Artist'}],
+        'album': {'name': 'Fake Album'},
+    }
+
+
+async def _wait():
+    if LATENCY:
+        await asyncio.sleep(LATENCY)
+
+
+async def me(_: Request):
+    await _wait()
+    return JSONResponse({'id': 'fake-user', 'display_name': 'Fake User', 'email': 'fake@example.com'})
+
+
+async def token(_: Request):
+    await _wait()
+    return JSONResponse({'access_token': _id(), 'refresh_token': _id(), 'expires_in': 3600, 'token_type': 'Bearer'})
+
+
+async def search(request: Request):
+    await _wait()
+    limit = int(request.query_params.get('limit', 20))
+    return JSONResponse({'tracks': {'items': [_track(_id()) for _ in range(limit)]}})
+
+
+async def tracks(request: Request):
+    await _wait()
+    ids = request.query_params.get('ids', '').split(',')
+    if len(ids) > 50:
+        return JSONResponse({'error': {'status': 400, 'message': 'Too many ids requested'}}, status_code=400)
+    return JSONResponse({'tracks': [_track(i) for i in ids if i]})
+
+
+async def create_playlist(request: Request):
+    await _wait()
+    body = await request.json()
+    playlist_id = _id()
+    playlists[playlist_id] = {'collaborative': body.get('collaborative', False), 'tracks': [], 'snapshot': 0}
+    return JSONResponse({'id': playlist_id, 'name': body.get('name')}, status_code=201)
+
+
+def _playlist(request: Request):
+    return playlists.setdefault(request.path_params['id'], {'collaborative': True, 'tracks': [], 'snapshot': 0})
+
+
+def _page(playlist, offset, limit):
+    items = [{'track': _track(t)} for t in playlist['tracks'][offset:offset + limit]]
+    total = len(playlist['tracks'])
+    next_url = None
+    if offset + limit < total:
+        next_url = f'/tracks?offset={offset + limit}&limit={limit}'
+    return {'items': items, 'total': total, 'offset': offset, 'limit': limit, 'next': next_url}
+
+
+async def playlist(request: Request):
+    await _wait()
+    data = _playlist(request)
+    if request.method == 'PUT':
+        data.update(await request.json())
+        return JSONResponse({})
+    return JSONResponse({'id': request.path_params['id'], 'collaborative': data['collaborative'],
+                         'snapshot_id': str(data['snapshot']), 'tracks': _page(data, 0, 100)})
+
+
+async def playlist_tracks(request: Request):
+    await _wait()
+    data = _playlist(request)
+    if request.method == 'GET':
+        offset = int(request.query_params.get('offset', 0))
+        limit = int(request.query_params.get('limit', 100))
+        page = _page(data, offset, limit)
+        if page['next']:
+            page['next'] = f'{request.url_for("playlist_tracks", id=request.path_params["id"])}?offset={offset + limit}&limit={limit}'
+        return JSONResponse(page)
+
+    body = await request.json()
+    if request.method == 'POST':
+        uris = body.get('uris', [])
+        if len(uris) > 100:
+            return JSONResponse({'error': {'status': 400, 'message': 'Too many tracks'}}, status_code=400)
+        data['tracks'].extend(uri.rsplit(':', 1)[-1] for uri in uris)
+        data['snapshot'] += 1
+        return JSONResponse({'snapshot_id': str(data['snapshot'])}, status_code=201)
+
+    removed = {item['uri'].rsplit(':', 1)[-1] for item in body.get('tracks', [])}
+    if len(removed) > 100:
+        return JSONResponse({'error': {'status': 400, 'message': 'Too many tracks'}}, status_code=400)
+    data['tracks'] = [t for t in data['tracks'] if t not in removed]
+    data['snapshot'] += 1
+    return JSONResponse({'snapshot_id': str(data['snapshot'])})
+
+
+async def unfollow(request: Request):
+    await _wait()
+    if playlists.pop(request.path_params['id'], None) is None:
+        return JSONResponse({'error': {'status': 404}}, status_code=404)
+    return JSONResponse({})
+
+
+app = Starlette(routes=[
+    Route('/api/token', token, methods=['POST']),
+    Route('/v1/me', me),
+    Route('/v1/search', search),
+    Route('/v1/tracks', tracks),
+    Route('/v1/users/{user}/playlists', create_playlist, methods=['POST']),
+    Route('/v1/playlists/{id}', playlist, methods=['GET', 'PUT']),
+    Route('/v1/playlists/{id}/tracks', playlist_tracks, methods=['GET', 'POST', 'DELETE'], name='playlist_tracks'),
+    Route('/v1/playlists/{id}/followers', unfollow, methods=['DELETE']),
+])
+
+
+def serve(port: int = 9000) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
@@ -0,0 +1,117 @@
+"""Follower lists and relationship checks over a 1M edge follow graph.
+
+    DATABASE_URL=sqlite:////tmp/follows.db python -m benchmarks.follow_graph --users 50000 --edges 1000000
+
+Seeds a skewed graph, where a few users have tens of thousands of
+followers and most have a handful. It then times, on the 100 most-followed
+users:
+- a followers page read straight from the follows indexes (the path
+  users above FOLLOW_CACHE_MAX_DEGREE take)
+- a page on a cold adjacency cache, which loads the user's whole list
+- a page on a warm cache
+- follows-you checks against the pair index and against the cache
+- the incremental cache update done by follow/unfollow
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/follows.db')
+
+from sqlalchemy import select, insert, func  # noqa: E402
+from app.schemas import follows  # noqa: E402
+from app.schemas.database import engine, session  # noqa: E402
+from app.schemas.migrations import upgrade  # noqa: E402
+from app.schemas.model import UserModel, Following  # noqa: E402
+
+
+def seed(users, edges):
+    with engine.begin() as conn:
+        if conn.scalar(select(func.count()).select_from(Following)) >= edges:
+            return
+    start = time.perf_counter()
+    pairs = set()
+    while len(pairs) < edges:
+        follower = random.randrange(1, users + 1)
+        # Pareto-distributed targets give a handful of very popular users
+        followed = min(int(random.paretovariate(0.6)), users)
+        if follower != followed:
+            pairs.add((follower, followed))
+    following, followers = [0] * (users + 1), [0] * (users + 1)
+    for a, b in pairs:
+        following[a] += 1
+        followers[b] += 1
+    with engine.begin() as conn:
+        conn.execute(insert(UserModel), [
+            {'id': i, 'username': f'bench{i}', 'email': f'bench{i}@example.com', 'created_playlist': 0,
+             'followers': followers[i], 'following': following[i], 'level': 'bench'} for i in range(1, users + 1)])
+        rows = [{'following': a, 'follower': b} for a, b in pairs]
+        for start_at in range(0, len(rows), 200000):
+            conn.execute(insert(Following), rows[start_at:start_at + 200000])
+    print(f'seeded {users} users and {edges} edges in {time.perf_counter() - start:.1f} s')
+
+
+async def timed(calls):
+    timings = []
+    for call in calls:
+        async with session() as db:
+            start = time.perf_counter()
+            await call(db)
+            timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000, max(timings) * 1000
+
+
+def report(label, result):
+    print(f'{label:>28}: p50 {result[0]:8.3f} ms  max {result[1]:8.3f} ms')
+
+
+async def main(users, limit):
+    async with session() as db:
+        hot = list(await db.scalars(select(UserModel.id).order_by(UserModel.followers.desc()).limit(100)))
+        top = await db.scalar(select(UserModel.followers).where(UserModel.id == hot[0]))
+    print(f'most followed user has {top} followers')
+
+    def pages():
+        return [lambda db, user=user: follows.page(db, follows.FOLLOWERS, user, users // 2, limit) for user in hot]
+
+    max_degree = follows.MAX_DEGREE
+    follows.MAX_DEGREE = 0
+    report('indexed keyset page', await timed(pages()))
+    follows.MAX_DEGREE = max_degree
+
+    results = []
+    for call in pages():
+        follows._cache[follows.FOLLOWERS].clear()
+        results.append(await timed([call]))
+    report('cold cache page', (statistics.median(r[0] for r in results), max(r[1] for r in results)))
+    await timed(pages())
+    report('warm cache page', await timed(pages()))
+
+    checks = [lambda db, user=user: follows.follows(db, random.randrange(1, users + 1), user) for user in hot]
+    for cache in follows._cache.values():
+        cache.clear()
+    report('follows-you, pair index', await timed(checks))
+    await timed(pages())
+    report('follows-you, cached', await timed(checks))
+
+    start = time.perf_counter()
+    for user in hot:
+        follows.followed(users + 1, user)
+        follows.unfollowed(users + 1, user)
+    print(f'{"follow+unfollow cache update":>28}: {(time.perf_counter() - start) / len(hot) * 1e6:8.1f} us per pair')
+    print(f'{"cache":>28}: {len(follows._cache[follows.FOLLOWERS])} users, '
+          f'{follows._cache[follows.FOLLOWERS].currsize} edges')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--edges', type=int, default=1000000)
+    parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args()
+    upgrade()
+    seed(args.users, args.edges)
+    asyncio.run(main(args.users, args.limit))
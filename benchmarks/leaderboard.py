@@ -0,0 +1,71 @@
+"""/most_vote latency with N playlists: two ORDER BY scans vs the indexed score.
+
+    DATABASE_URL=sqlite:////tmp/leaderboard.db python -m benchmarks.leaderboard --size 1000000
+
+Seeds N playlists with random ratings and plays (score filled in the way the
+reconcile job would), then times the old pair of `ORDER BY rating/plays
+LIMIT 1` queries next to the first and a deep page of the keyset leaderboard.
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/leaderboard.db')
+
+from sqlalchemy import select, insert, delete, desc, or_, and_, func  # noqa: E402
+from app.schemas.database import engine  # noqa: E402
+from app.schemas.model import data, Playlist, UserModel  # noqa: E402
+from app.schemas.counters import RATING_WEIGHT, PLAYS_WEIGHT  # noqa: E402
+
+
+def seed(conn, size):
+    if conn.scalar(select(func.count()).select_from(Playlist).where(Playlist.id.like('bench-%'))) == size:
+        return
+    conn.execute(delete(Playlist).where(Playlist.id.like('bench-%')))
+    if conn.scalar(select(UserModel.id).where(UserModel.id == 1)) is None:
+        conn.execute(insert(UserModel).values(id=1, username='bench', email='bench@example.com'))
+    for start in range(0, size, 100000):
+        rows = []
+        for i in range(start, min(size, start + 100000)):
+            rating, plays = round(random.uniform(0, 5), 2), random.randint(0, 50)
+            rows.append({'id': f'bench-{i:07}', 'name': f'bench {i}', 'user_id': 1, 'rating': rating,
+                         'plays': plays, 'score': rating * RATING_WEIGHT + plays * PLAYS_WEIGHT})
+        conn.execute(insert(Playlist), rows)
+    conn.commit()
+
+
+def old_most_vote(conn):
+    conn.execute(select(Playlist).order_by(Playlist.rating.desc()).limit(1)).first()
+    conn.execute(select(Playlist).order_by(Playlist.plays.desc()).limit(1)).first()
+
+
+def page(conn, limit=10, last=None):
+    query = select(Playlist.id, Playlist.score)
+    if last:
+        query = query.where(or_(Playlist.score < last[0], and_(Playlist.score == last[0], Playlist.id > last[1])))
+    return conn.execute(query.order_by(desc(Playlist.score), Playlist.id).limit(limit)).all()
+
+
+def timed(call, rounds=20):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=100000)
+    args = parser.parse_args()
+    data.metadata.create_all(bind=engine)
+    with engine.connect() as conn:
+        seed(conn, args.size)
+        deep = page(conn, limit=1000)[-1]
+        print(f'{args.size:>8} playlists:')
+        print(f'{"two ORDER BY scans":>24}: {timed(lambda: old_most_vote(conn)):8.2f} ms')
+        print(f'{"score index, page 1":>24}: {timed(lambda: page(conn)):8.2f} ms')
+        print(f'{"score index, page 101":>24}: {timed(lambda: page(conn, last=tuple(deep))):8.2f} ms')
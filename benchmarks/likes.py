@@ -0,0 +1,89 @@
+"""Like/dislike toggle latency as one playlist collects more likes.
+
+    DATABASE_URL=sqlite:////tmp/likes.db python -m benchmarks.likes --sizes 1000 10000 100000 1000000
+
+For each size the playlist is seeded with that many likers, then a fresh user
+flips between like and dislike. The old handler body (selectinload both
+liker lists, then `member in playlist.liked_by`) is timed next to the
+primary-key probes in app.router.play.vote.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/likes.db')
+os.environ.setdefault('POSTMARK', 'bench')
+
+from sqlalchemy import select, delete, insert  # noqa: E402
+from sqlalchemy.orm import selectinload  # noqa: E402
+from app.schemas.database import engine, session  # noqa: E402
+from app.schemas.model import data, Playlist, UserModel, playlist_likes, playlist_dislikes  # noqa: E402
+from app.router.play import vote  # noqa: E402
+
+PLAYLIST = 'bench-likes'
+VOTER = 0
+
+
+def seed(size):
+    with engine.begin() as conn:
+        have = conn.scalar(select(UserModel.id).order_by(UserModel.id.desc()).limit(1)) or 0
+        if have < size:
+            conn.execute(insert(UserModel), [{'id': i, 'username': f'bench{i}', 'email': f'bench{i}@example.com'}
+                                             for i in range(have + 1, size + 1)])
+        conn.execute(delete(Playlist).where(Playlist.id == PLAYLIST))
+        conn.execute(insert(Playlist).values(id=PLAYLIST, name='bench', user_id=1, likes=size))
+        conn.execute(insert(playlist_likes), [{'playlist_id': PLAYLIST, 'user_id': i} for i in range(1, size + 1)])
+        if conn.scalar(select(UserModel.id).where(UserModel.id == VOTER)) is None:
+            conn.execute(insert(UserModel).values(id=VOTER, username='voter', email='voter@example.com'))
+
+
+async def old_like(db, table):
+    playlist = await db.scalar(select(Playlist).options(selectinload(Playlist.liked_by),
+                                                        selectinload(Playlist.disliked_by)).
+                               where(Playlist.id == PLAYLIST))
+    member = await db.get(UserModel, VOTER)
+    mine, other = ((playlist.liked_by, playlist.disliked_by) if table is playlist_likes
+                   else (playlist.disliked_by, playlist.liked_by))
+    if member in mine:
+        return
+    mine.append(member)
+    if member in other:
+        other.remove(member)
+    await db.commit()
+
+
+async def new_like(db, table):
+    if table is playlist_likes:
+        await vote(db, PLAYLIST, VOTER, playlist_likes, Playlist.likes, playlist_dislikes, Playlist.dislike)
+    else:
+        await vote(db, PLAYLIST, VOTER, playlist_dislikes, Playlist.dislike, playlist_likes, Playlist.likes)
+
+
+async def timed(toggle, rounds):
+    timings = []
+    for i in range(rounds):
+        async with session() as db:
+            start = time.perf_counter()
+            await toggle(db, playlist_likes if i % 2 else playlist_dislikes)
+            timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+async def main(sizes, rounds):
+    for size in sizes:
+        seed(size)
+        new = await timed(new_like, rounds)
+        # Past 100k the old path takes minutes per click, don't bother
+        old = f'{await timed(old_like, max(2, rounds // 10)):9.2f} ms' if size <= 100000 else '  skipped   '
+        print(f'{size:>8} likes:  selectinload {old}   pk probes {new:7.2f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+    data.metadata.create_all(bind=engine)
+    asyncio.run(main(args.sizes, args.rounds))
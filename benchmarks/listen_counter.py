@@ -0,0 +1,101 @@
+"""Lost increments under concurrent listens: read-modify-write vs the listen buffer.
+
+    DATABASE_URL=sqlite:////tmp/listens.db python -m benchmarks.listen_counter --listens 1000
+
+Fires N concurrent listens at one playlist, once the old way (load the row,
+plays += 1, commit) and once through app.schemas.listens with a flusher
+running alongside, then compares the stored count with N. It then buffers N
+listens and cancels a flush while its write is in flight, the way shutdown
+cancels the flush loop, and checks drain() still stores all of them. Exits
+non-zero if the buffered path loses anything.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/listens.db')
+os.environ.setdefault('PLAYS_FLUSH_INTERVAL', '0.05')
+
+from sqlalchemy import select, delete  # noqa: E402
+from app.schemas.database import session  # noqa: E402
+from app.schemas.migrations import upgrade  # noqa: E402
+from app.schemas.model import Playlist, UserModel  # noqa: E402
+from app.schemas import listens  # noqa: E402
+
+
+async def reset():
+    async with session() as db:
+        await db.execute(delete(Playlist).where(Playlist.id == 'bench-listens'))
+        if not await db.get(UserModel, 1):
+            db.add(UserModel(id=1, username='bench', email='bench@example.com'))
+            await db.flush()
+        db.add(Playlist(id='bench-listens', name='bench', user_id=1, plays=0))
+        await db.commit()
+
+
+async def stored():
+    async with session() as db:
+        return await db.scalar(select(Playlist.plays).where(Playlist.id == 'bench-listens'))
+
+
+async def read_modify_write():
+    async with session() as db:
+        playlist = await db.get(Playlist, 'bench-listens')
+        playlist.plays += 1
+        await db.commit()
+
+
+async def buffered():
+    listens.record('bench-listens')
+    await asyncio.sleep(0)
+
+
+async def run(label, listen, count):
+    await reset()
+    flusher = asyncio.create_task(listens.flush_loop())
+    start = time.perf_counter()
+    results = await asyncio.gather(*(listen() for _ in range(count)), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    flusher.cancel()
+    await asyncio.gather(flusher, return_exceptions=True)
+    await listens.drain()
+    plays = await stored()
+    errors = sum(isinstance(result, Exception) for result in results)
+    print(f'{label:>18}: {plays:6} / {count} stored  lost {count - plays:5}  errors {errors:5}  '
+          f'{elapsed * 1000:8.1f} ms')
+    return plays
+
+
+async def cancelled_flush(label, flusher, count):
+    await reset()
+    for _ in range(count):
+        listens.record('bench-listens')
+    task = asyncio.create_task(flusher())
+    # The batch leaves the buffer when the write starts; cancel right then
+    while listens.pending():
+        await asyncio.sleep(0)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await listens.drain()
+    plays = await stored()
+    print(f'{label:>18}: {plays:6} / {count} stored  lost {count - plays:5}')
+    return plays
+
+
+async def main(count):
+    await run('read-modify-write', read_modify_write, count)
+    plays = [await run('listen buffer', buffered, count),
+             await cancelled_flush('cancelled flush', listens.flush, count),
+             await cancelled_flush('cancelled loop', listens.flush_loop, count)]
+    print(f'{"":>18}  {listens.flush_stats}')
+    return all(stored_plays == count for stored_plays in plays)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--listens', type=int, default=1000)
+    args = parser.parse_args()
+    upgrade()
+    sys.exit(0 if asyncio.run(main(args.listens)) else 1)
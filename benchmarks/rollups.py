@@ -0,0 +1,116 @@
+"""Incremental weekly rollup vs rescanning the whole playlist event log.
+
+    DATABASE_URL=sqlite:////tmp/rollups.db python -m benchmarks.rollups --events 50000000
+
+Seeds N listen/rating events spread over 52 weeks and 100k playlists and
+folds them into playlist_week. It then appends one more batch (--batch
+events) and times:
+- the incremental rollup over just that batch
+- a full GROUP BY over the whole log, which is what a non-incremental job
+  would have to run
+- a top-10 read for one week
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/rollups.db')
+
+from sqlalchemy import select, insert, func, case  # noqa: E402
+from app.schemas.database import engine, session  # noqa: E402
+from app.schemas.model import data, PlaylistEvent, Playlist, UserModel  # noqa: E402
+from app.schemas.rollups import rollup, top_week, LISTEN, RATING, RATING_CHANGE  # noqa: E402
+
+PLAYLISTS = 100000
+WEEKS = [202600 + week for week in range(1, 53)]
+
+
+def events(count):
+    for _ in range(count):
+        if random.random() < 0.9:
+            yield {'playlist_id': f'bench-{random.randrange(PLAYLISTS)}', 'week': random.choice(WEEKS),
+                   'kind': LISTEN, 'value': random.randint(1, 20)}
+        else:
+            yield {'playlist_id': f'bench-{random.randrange(PLAYLISTS)}', 'week': random.choice(WEEKS),
+                   'kind': RATING, 'value': round(random.uniform(0, 5), 1)}
+
+
+def append(count):
+    with engine.begin() as conn:
+        rows = []
+        for event in events(count):
+            rows.append(event)
+            if len(rows) == 200000:
+                conn.execute(insert(PlaylistEvent), rows)
+                rows = []
+        if rows:
+            conn.execute(insert(PlaylistEvent), rows)
+
+
+def seed_playlists():
+    # top_week joins playlist for names, so the ids in the log have to exist
+    with engine.begin() as conn:
+        if conn.scalar(select(func.count()).select_from(Playlist).where(Playlist.id.like('bench-%'))):
+            return
+        if conn.scalar(select(UserModel.id).where(UserModel.id == 1)) is None:
+            conn.execute(insert(UserModel).values(id=1, username='bench', email='bench@example.com'))
+        conn.execute(insert(Playlist), [{'id': f'bench-{i}', 'name': f'bench {i}', 'user_id': 1}
+                                        for i in range(PLAYLISTS)])
+
+
+def full_rescan():
+    with engine.connect() as conn:
+        conn.execute(select(PlaylistEvent.week, PlaylistEvent.playlist_id,
+                            func.sum(case((PlaylistEvent.kind == LISTEN, PlaylistEvent.value), else_=0)),
+                            func.sum(case((PlaylistEvent.kind.in_((RATING, RATING_CHANGE)), PlaylistEvent.value),
+                                          else_=0)),
+                            func.sum(case((PlaylistEvent.kind == RATING, 1), else_=0))).
+                     group_by(PlaylistEvent.week, PlaylistEvent.playlist_id)).all()
+
+
+async def catch_up():
+    async with session() as db:
+        await rollup(db)
+        await rollup(db)
+
+
+async def top():
+    timings = []
+    for week in random.sample(WEEKS, 10):
+        async with session() as db:
+            start = time.perf_counter()
+            await top_week(db, week, 10)
+            timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+async def main(count, batch):
+    seed_playlists()
+    with engine.connect() as conn:
+        have = conn.scalar(select(func.count()).select_from(PlaylistEvent))
+    if have < count:
+        start = time.perf_counter()
+        append(count - have)
+        print(f'seeded {count - have} events in {time.perf_counter() - start:.1f} s')
+    await catch_up()
+
+    append(batch)
+    start = time.perf_counter()
+    await catch_up()
+    print(f'{"incremental rollup":>22}: {time.perf_counter() - start:8.3f} s for {batch} new events')
+    start = time.perf_counter()
+    full_rescan()
+    print(f'{"full rescan":>22}: {time.perf_counter() - start:8.3f} s over {count + batch} events')
+    print(f'{"week top-10":>22}: {await top():8.2f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=5000000)
+    parser.add_argument('--batch', type=int, default=100000)
+    args = parser.parse_args()
+    data.metadata.create_all(bind=engine)
+    asyncio.run(main(args.events, args.batch))
@@ -0,0 +1,60 @@
+"""Requests per second against the fake Spotify with N concurrent clients.
+
+    python -m benchmarks.spotify_client --clients 50 --requests 20
+
+Compares the old pattern (blocking `requests` calls inside coroutines) with
+the pooled async client in app.schemas.spotify.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+import requests
+
+PORT = int(os.getenv('FAKE_SPOTIFY_PORT', 9000))
+os.environ.setdefault('SPOTIFY_API_URL', f'http://127.0.0.1:{PORT}/v1')
+
+from app.schemas import spotify  # noqa: E402
+from benchmarks.fake_spotify import serve  # noqa: E402
+
+
+async def blocking_call():
+    requests.get(f'{spotify.API_URL}/me', headers={'Authorization': 'Bearer bench'})
+
+
+async def pooled_call():
+    await spotify.api('GET', '/me', 'bench')
+
+
+async def run(call, clients, per_client):
+    latencies = []
+
+    async def worker():
+        for _ in range(per_client):
+            start = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(latencies) / elapsed, statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1]
+
+
+async def main(clients, per_client):
+    for name, call in (('blocking requests', blocking_call), ('pooled httpx', pooled_call)):
+        rps, p50, p99 = await run(call, clients, per_client)
+        print(f'{name:>18}: {rps:8.1f} req/s  p50 {p50 * 1000:7.1f} ms  p99 {p99 * 1000:7.1f} ms')
+    await spotify.close_client()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+    server = serve(PORT)
+    asyncio.run(main(args.clients, args.requests))
+    server.should_exit = True
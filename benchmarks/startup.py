@@ -0,0 +1,62 @@
+"""Cold-start cost: time to import app.main and time to the first HTTP response.
+
+    DATABASE_URL=sqlite:////tmp/startup.db python -m benchmarks.startup --runs 10
+
+Every run is a fresh interpreter, the way a scaled-from-zero container starts.
+Import time is measured inside the child process. Time to first response is
+measured from spawning uvicorn to the first 200 from GET /, polled every
+10 ms. Migrations are applied once up front so startup never has to create
+tables.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import httpx
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/startup.db')
+for name, value in {'SECRET': 'bench', 'ALGORITHM': 'HS256', 'POSTMARK': 'bench', 'FROM': 'bench@example.com'}.items():
+    os.environ.setdefault(name, value)
+
+IMPORT = 'import time; start = time.perf_counter(); import app.main; print(time.perf_counter() - start)'
+
+
+def import_time():
+    return float(subprocess.run([sys.executable, '-c', IMPORT], check=True, capture_output=True, text=True).stdout)
+
+
+def first_response(port):
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'app.main:app', '--port', str(port),
+                               '--log-level', 'warning'])
+    try:
+        while True:
+            try:
+                if httpx.get(f'http://127.0.0.1:{port}/', timeout=1).status_code == 200:
+                    return time.perf_counter() - start
+            except httpx.TransportError:
+                pass
+            if server.poll() is not None:
+                raise RuntimeError('uvicorn exited before answering')
+            time.sleep(0.01)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(runs, port):
+    subprocess.run([sys.executable, '-m', 'app.schemas.migrations'], check=True, capture_output=True)
+    imports = [import_time() for _ in range(runs)]
+    responses = [first_response(port) for _ in range(runs)]
+    for label, timings in (('import app.main', imports), ('first response', responses)):
+        print(f'{label:>16}: p50 {statistics.median(timings) * 1000:7.1f} ms  max {max(timings) * 1000:7.1f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    main(args.runs, args.port)
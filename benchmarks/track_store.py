@@ -0,0 +1,59 @@
+"""Memory per entry and lookup latency of the in-process track store.
+
+    python -m benchmarks.track_store --size 1000000
+
+Compares TrackRecord entries in the LRU store against keeping the raw
+Spotify-shaped dicts the handlers used to throw away.
+"""
+import argparse
+import random
+import string
+import time
+import tracemalloc
+from cachetools import LRUCache
+from app.schemas.tracks import TrackRecord
+
+ARTISTS = [f'Artist {i}' for i in range(20000)]
+ALBUMS = [f'Album {i}' for i in range(50000)]
+
+
+def spotify_track(i):
+    track_id = ''.join(random.choices(string.ascii_letters + string.digits, k=22))
+    return {'id': track_id, 'name': f'Song number {i}', 'duration_ms': random.randint(90000, 400000),
+            'artists': [{'name': random.choice(ARTISTS)}], 'album': {'name': random.choice(ALBUMS)}}
+
+
+def fill(size, make):
+    tracemalloc.start()
+    store = LRUCache(maxsize=size)
+    ids = []
+    for i in range(size):
+        track = spotify_track(i)
+        store[track['id']] = make(track)
+        ids.append(track['id'])
+    # The id list and sample payloads are bench overhead, measure only what the store holds
+    used = tracemalloc.get_traced_memory()[0] - len(ids) * 8
+    tracemalloc.stop()
+    return store, ids, used
+
+
+def lookups(store, ids, count=200000):
+    sample = random.choices(ids, k=count)
+    start = time.perf_counter()
+    for track_id in sample:
+        store[track_id]
+    return (time.perf_counter() - start) / count * 1e9
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=1000000)
+    args = parser.parse_args()
+    for label, make in (('raw dict', lambda track: {'id': track['id'], 'name': track['name'],
+                                                    'artist': track['artists'][0]['name'],
+                                                    'album': track['album']['name'],
+                                                    'duration_ms': track['duration_ms']}),
+                        ('TrackRecord', TrackRecord.from_spotify)):
+        store, ids, used = fill(args.size, make)
+        print(f'{label:>12}: {used / args.size:6.0f} B/entry  lookup {lookups(store, ids):6.0f} ns')
+        del store, ids